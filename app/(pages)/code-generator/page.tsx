@@ -1,7 +1,7 @@
 "use client";
 
 import React, { useState } from 'react';
-import { fetchApi, getApiUrl } from '../../services/api';
+import { getApiUrl } from '../../services/api';
 
 export default function CodeGeneratorPage() {
   // --- State Hooks ---
@@ -10,6 +10,7 @@ export default function CodeGeneratorPage() {
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState('');
   const [result, setResult] = useState<{ codeId: string; filename: string } | null>(null);
+  const [preview, setPreview] = useState('');
 
   const handleSubmit = async (e: React.FormEvent) => {
     e.preventDefault();
@@ -18,13 +19,55 @@ export default function CodeGeneratorPage() {
     setIsLoading(true);
     setError('');
     setResult(null);
+    setPreview('');
 
     try {
-      const data = await fetchApi('/api/generate-code', {
+      const response = await fetch(getApiUrl('/api/generate-code/stream'), {
         method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ prompt, filename }),
       });
-      setResult({ codeId: data.code_id, filename: data.filename });
+
+      if (!response.ok) {
+        throw new Error(`API Error: ${response.statusText}`);
+      }
+
+      const reader = response.body?.getReader();
+      if (!reader) {
+        throw new Error('Failed to get response reader');
+      }
+
+      // Code is streamed as-is; the last line is a trailer carrying either the
+      // download ID (`__CODE_ID__::id::filename`) or an error (`__ERROR__::message`).
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        setPreview(buffer);
+      }
+      buffer += decoder.decode();
+
+      const trailerIndex = buffer.lastIndexOf('\n__');
+      const trailer = trailerIndex === -1 ? '' : buffer.slice(trailerIndex + 1).trim();
+      const code = trailerIndex === -1 ? buffer : buffer.slice(0, trailerIndex);
+      setPreview(code);
+
+      if (trailer.startsWith('__ERROR__::')) {
+        throw new Error(trailer.slice('__ERROR__::'.length));
+      }
+      if (!trailer.startsWith('__CODE_ID__::')) {
+        throw new Error('The generation stream ended unexpectedly.');
+      }
+      // The code ID never contains `::`; everything after it is the filename.
+      const fields = trailer.slice('__CODE_ID__::'.length);
+      const separator = fields.indexOf('::');
+      if (separator === -1) {
+        throw new Error('The generation stream ended unexpectedly.');
+      }
+      setResult({ codeId: fields.slice(0, separator), filename: fields.slice(separator + 2) });
 
     } catch (err: any) {
       setError(err.message);
@@ -94,6 +137,12 @@ export default function CodeGeneratorPage() {
               </div>
             )}
 
+            {preview && (
+              <pre className="mt-6 max-h-96 overflow-auto bg-gray-900 border border-gray-700 rounded-md p-3 text-sm text-gray-200">
+                <code>{preview}</code>
+              </pre>
+            )}
+
             {result && (
               <div className="mt-6 text-center">
                 <p className="text-green-400 mb-3">✅ Code generated successfully!</p>
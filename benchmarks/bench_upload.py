@@ -0,0 +1,115 @@
+# benchmarks/bench_upload.py
+"""
+Benchmark du chemin d'upload réel : analyse multipart par Starlette (le fichier
+est placé dans un SpooledTemporaryFile, en mémoire jusqu'à 1 Mo puis sur disque),
+suivie de l'extraction du texte.
+
+Deux chemins sont comparés pour chaque taille de fichier .txt :
+  - "copie"  : ancien chemin, copie du fichier dans temp_uploads/ puis relecture ;
+  - "direct" : chemin actuel, extraction incrémentale depuis le fichier de Starlette.
+
+Mesure le temps moyen par upload, le pic d'allocation Python (tracemalloc) et
+les octets écrits sur disque (spool de Starlette + copie éventuelle).
+
+Usage : python benchmarks/bench_upload.py
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlette.datastructures import Headers
+from starlette.formparsers import MultiPartParser
+import upload_service
+
+SIZES = [16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+ROUNDS = 5
+BOUNDARY = "jules-bench-boundary"
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def make_multipart_body(size: int) -> bytes:
+    line = "Jules indexe ce paragraphe de connaissances — données de test.\n".encode("utf-8")
+    payload = (line * (size // len(line) + 1))[:size].decode("utf-8", errors="ignore").encode("utf-8")
+    return (
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="bench.txt"\r\n'
+        f"Content-Type: text/plain\r\n\r\n"
+    ).encode("utf-8") + payload + f"\r\n--{BOUNDARY}--\r\n".encode("utf-8")
+
+
+async def parse_upload(body: bytes):
+    """Parse a multipart body exactly as FastAPI does for `UploadFile = File(...)`."""
+    async def stream():
+        for i in range(0, len(body), STREAM_BLOCK_SIZE):
+            yield body[i:i + STREAM_BLOCK_SIZE]
+        yield b""
+
+    headers = Headers({"content-type": f"multipart/form-data; boundary={BOUNDARY}", "content-length": str(len(body))})
+    form = await MultiPartParser(headers, stream()).parse()
+    return form["file"]
+
+
+def spooled_disk_bytes(upload) -> int:
+    return upload.size if getattr(upload.file, "_rolled", False) else 0
+
+
+def copy_path(body: bytes, temp_dir: str) -> tuple[int, int]:
+    """Ancien chemin : spool de Starlette, copie dans temp_uploads/, relecture complète."""
+    upload = asyncio.run(parse_upload(body))
+    file_path = os.path.join(temp_dir, upload.filename)
+    try:
+        with open(file_path, "wb") as buffer:
+            shutil.copyfileobj(upload.file, buffer)
+        with open(file_path, "r", encoding="utf-8") as f:
+            text = f.read()
+        chunks = [text[i:i + 1000] for i in range(0, len(text), 800)]
+        return len(chunks), spooled_disk_bytes(upload) + upload.size
+    finally:
+        upload.file.close()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def direct_path(body: bytes) -> tuple[int, int]:
+    """Chemin actuel : extraction incrémentale directement depuis le spool de Starlette."""
+    upload = asyncio.run(parse_upload(body))
+    try:
+        upload.file.seek(0)
+        chunks = list(upload_service.iter_text_chunks(upload_service.iter_txt_text(upload.file)))
+        return len(chunks), spooled_disk_bytes(upload)
+    finally:
+        upload.file.close()
+
+
+def measure(fn, *args) -> tuple[float, int, int]:
+    # Le temps est mesuré hors tracemalloc, qui ralentit fortement les allocations Python.
+    durations, disk = [], 0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        _, disk = fn(*args)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return sum(durations) / ROUNDS, peak, disk
+
+
+def main():
+    print(f"{'taille':>10} | {'chemin':<8} | {'temps (ms)':>10} | {'pic mémoire (Ko)':>16} | {'disque (Ko)':>11}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in SIZES:
+            body = make_multipart_body(size)
+            for name, fn, args in (("copie", copy_path, (body, temp_dir)), ("direct", direct_path, (body,))):
+                avg, peak, disk = measure(fn, *args)
+                print(f"{size // 1024:>8}Ko | {name:<8} | {avg * 1000:>10.2f} | {peak // 1024:>16} | {disk // 1024:>11}")
+
+
+if __name__ == "__main__":
+    main()
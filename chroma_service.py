@@ -1,8 +1,12 @@
 # chroma_service.py
 # --- Imports ---
 import chromadb
+import contextlib
+import hashlib
 import logging
 import os
+import threading
+import time
 
 # --- Logging Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -13,6 +17,46 @@ logger = logging.getLogger(__name__)
 # 1. Client Initialization
 CHROMA_DATA_PATH = "chroma_db"
 COLLECTION_NAME = "jules_knowledge"
+# Nombre d'éléments lus par page lors des parcours complets de la collection.
+PAGE_SIZE = 500
+
+# Serializes writes so that a reindex cannot miss documents written during the copy.
+# Reads are never blocked: they keep using the current collection until the swap.
+_write_lock = threading.RLock()
+# Held for the whole reindex. Writes arriving meanwhile are rejected instead of parking
+# a worker thread on `_write_lock`, which would starve the reads sharing the same pool.
+_reindex_lock = threading.Lock()
+# Délai entre deux vérifications d'une réindexation en cours pendant l'attente du verrou d'écriture.
+WRITE_LOCK_POLL_SECONDS = 0.1
+# Délai suggéré aux clients dont l'écriture a été refusée pendant une réindexation.
+REINDEX_RETRY_AFTER_SECONDS = 30
+
+
+class ReindexInProgressError(Exception):
+    """Raised when a write is attempted while the collection is being reindexed."""
+
+    def __init__(self, message: str = "A reindex of the collection is in progress."):
+        super().__init__(message)
+        self.retry_after = REINDEX_RETRY_AFTER_SECONDS
+
+
+@contextlib.contextmanager
+def _write_access():
+    """
+    Hold the write lock for a write, failing fast while a reindex is in progress.
+
+    Writes only ever wait for other short writes; as soon as a reindex is
+    underway they raise `ReindexInProgressError`.
+    """
+    while True:
+        if _reindex_lock.locked():
+            raise ReindexInProgressError()
+        if _write_lock.acquire(timeout=WRITE_LOCK_POLL_SECONDS):
+            break
+    try:
+        yield
+    finally:
+        _write_lock.release()
 
 try:
     # Ensure the directory exists
@@ -37,6 +81,10 @@ def is_ready():
     """Check if the ChromaDB client and collection are available."""
     return client is not None and collection is not None
 
+def is_reindexing():
+    """Check if a reindex is in progress, during which writes are rejected."""
+    return _reindex_lock.locked()
+
 def upsert_documents(datapoint_ids: list[str], documents: list[str], embeddings: list[list[float]], metadatas: list[dict]):
     """
     Upsert documents and their embeddings into the ChromaDB collection.
@@ -52,12 +100,13 @@ def upsert_documents(datapoint_ids: list[str], documents: list[str], embeddings:
         raise ConnectionError("ChromaDB service is not available.")
 
     try:
-        collection.upsert(
-            ids=datapoint_ids,
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas
-        )
+        with _write_access():
+            collection.upsert(
+                ids=datapoint_ids,
+                embeddings=embeddings,
+                documents=documents,
+                metadatas=metadatas
+            )
         logger.info(f"Successfully upserted {len(datapoint_ids)} documents into '{COLLECTION_NAME}'.")
     except Exception as e:
         logger.error(f"An error occurred while upserting to ChromaDB: {e}")
@@ -90,3 +139,205 @@ def query_collection(query_embedding: list[float], num_results: int = 3):
         logger.error(f"An error occurred while querying ChromaDB: {e}")
         # Depending on the desired error handling, you might want to re-raise or handle differently
         raise
+
+def query_collection_batch(query_embeddings: list[list[float]], num_results: int = 3):
+    """
+    Query the collection for several embeddings in a single call.
+
+    Args:
+        query_embeddings (list[list[float]]): The embeddings of the query texts.
+        num_results (int): The number of results to return per query.
+
+    Returns:
+        dict: The query results from ChromaDB, with one result list per query embedding.
+    """
+    if not is_ready():
+        logger.error("ChromaDB service is not ready. Cannot query collection.")
+        raise ConnectionError("ChromaDB service is not available.")
+
+    try:
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=num_results
+        )
+        logger.info(f"Batch query of {len(query_embeddings)} embeddings returned results from '{COLLECTION_NAME}'.")
+        return results
+    except Exception as e:
+        logger.error(f"An error occurred while batch querying ChromaDB: {e}")
+        raise
+
+def _iter_pages(source_collection, include: list[str]):
+    """Yield successive pages of a collection, as returned by `get`."""
+    offset = 0
+    while True:
+        page = source_collection.get(include=include, limit=PAGE_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        yield page
+        offset += len(page['ids'])
+
+def _directory_size(path: str) -> int:
+    """Return the total size in bytes of the files under `path`."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def get_collection_stats():
+    """
+    Compute statistics about the knowledge collection.
+
+    Returns:
+        dict: The total chunk count, the chunk count and text size per source
+        file (largest first), and the on-disk size of the ChromaDB data directory.
+    """
+    if not is_ready():
+        logger.error("ChromaDB service is not ready. Cannot compute stats.")
+        raise ConnectionError("ChromaDB service is not available.")
+
+    sources = {}
+    for page in _iter_pages(collection, include=["documents", "metadatas"]):
+        for document, metadata in zip(page['documents'], page['metadatas']):
+            source = (metadata or {}).get("source_file", "unknown")
+            stats = sources.setdefault(source, {"source_file": source, "chunks": 0, "text_bytes": 0})
+            stats["chunks"] += 1
+            stats["text_bytes"] += len((document or "").encode("utf-8"))
+
+    return {
+        "collection": collection.name,
+        "chunk_count": collection.count(),
+        "sources": sorted(sources.values(), key=lambda s: s["chunks"], reverse=True),
+        "disk_size_bytes": _directory_size(CHROMA_DATA_PATH),
+    }
+
+def delete_by_source(source_files: list[str]) -> int:
+    """
+    Delete every chunk that belongs to one of the given source files.
+
+    Args:
+        source_files (list[str]): The `source_file` metadata values to delete.
+
+    Returns:
+        int: The number of chunks deleted.
+    """
+    if not is_ready():
+        logger.error("ChromaDB service is not ready. Cannot delete documents.")
+        raise ConnectionError("ChromaDB service is not available.")
+
+    where = {"source_file": {"$in": source_files}}
+    with _write_access():
+        ids = collection.get(where=where, include=[])['ids']
+        if ids:
+            collection.delete(ids=ids)
+    logger.info(f"Deleted {len(ids)} chunks from {len(source_files)} sources in '{COLLECTION_NAME}'.")
+    return len(ids)
+
+def find_duplicates(remove: bool = False, limit: int = 100):
+    """
+    Find chunks whose text is identical, by SHA-256 of their content.
+
+    A read-only scan does not take the write lock, so uploads keep going
+    while the report is built; only a removal serializes with other writes.
+
+    Args:
+        remove (bool): If True, delete every duplicate but the first chunk of each group.
+        limit (int): The maximum number of groups listed in the report, largest first.
+
+    Returns:
+        dict: The number of duplicate groups, up to `limit` of them (content hash
+        and chunk IDs), the number of redundant chunks, and the number of chunks deleted.
+    """
+    if not is_ready():
+        logger.error("ChromaDB service is not ready. Cannot look for duplicates.")
+        raise ConnectionError("ChromaDB service is not available.")
+
+    with _write_access() if remove else contextlib.nullcontext():
+        ids_by_hash = {}
+        for page in _iter_pages(collection, include=["documents"]):
+            for chunk_id, document in zip(page['ids'], page['documents']):
+                content_hash = hashlib.sha256((document or "").encode("utf-8")).hexdigest()
+                ids_by_hash.setdefault(content_hash, []).append(chunk_id)
+
+        groups = [{"content_hash": h, "ids": ids} for h, ids in ids_by_hash.items() if len(ids) > 1]
+        redundant_ids = [chunk_id for group in groups for chunk_id in group["ids"][1:]]
+        deleted = 0
+        if remove and redundant_ids:
+            for i in range(0, len(redundant_ids), PAGE_SIZE):
+                collection.delete(ids=redundant_ids[i:i + PAGE_SIZE])
+            deleted = len(redundant_ids)
+            logger.info(f"Deleted {deleted} duplicate chunks from '{COLLECTION_NAME}'.")
+
+    groups.sort(key=lambda group: len(group["ids"]), reverse=True)
+    return {
+        "group_count": len(groups),
+        "groups": groups[:limit],
+        "redundant_chunks": len(redundant_ids),
+        "deleted": deleted,
+    }
+
+def reindex_collection():
+    """
+    Rebuild the collection into a fresh one and swap it in atomically.
+
+    The documents, embeddings and metadata are copied into a new collection,
+    which is then renamed to `COLLECTION_NAME` and replaces the module-level
+    collection; the old collection is dropped. This compacts the index after
+    bulk deletes. Queries keep running against the old collection during the
+    copy, while writes are rejected with `ReindexInProgressError` until the swap.
+
+    Returns:
+        dict: The number of chunks copied and the duration of the reindex.
+
+    Raises:
+        ReindexInProgressError: If another reindex is already running.
+    """
+    if not is_ready():
+        logger.error("ChromaDB service is not ready. Cannot reindex.")
+        raise ConnectionError("ChromaDB service is not available.")
+
+    if not _reindex_lock.acquire(blocking=False):
+        raise ReindexInProgressError()
+    try:
+        return _reindex_locked()
+    finally:
+        _reindex_lock.release()
+
+def _reindex_locked():
+    global collection
+    start = time.monotonic()
+    suffix = int(time.time())
+    # N'attend que la fin des écritures déjà commencées : les suivantes sont refusées.
+    with _write_lock:
+        old_collection = collection
+        new_collection = client.create_collection(name=f"{COLLECTION_NAME}__reindex_{suffix}", metadata=old_collection.metadata)
+        try:
+            for page in _iter_pages(old_collection, include=["documents", "embeddings", "metadatas"]):
+                new_collection.add(
+                    ids=page['ids'],
+                    embeddings=page['embeddings'],
+                    documents=page['documents'],
+                    metadatas=page['metadatas']
+                )
+            copied = new_collection.count()
+            if copied != old_collection.count():
+                raise RuntimeError(f"Reindex copied {copied} chunks out of {old_collection.count()}.")
+
+            old_collection.modify(name=f"{COLLECTION_NAME}__old_{suffix}")
+            try:
+                new_collection.modify(name=COLLECTION_NAME)
+            except Exception:
+                old_collection.modify(name=COLLECTION_NAME)
+                raise
+        except Exception:
+            client.delete_collection(name=new_collection.name)
+            raise
+        collection = new_collection
+        client.delete_collection(name=old_collection.name)
+
+    duration = time.monotonic() - start
+    logger.info(f"Reindexed {copied} chunks into a fresh '{COLLECTION_NAME}' collection in {duration:.2f}s.")
+    return {"chunks": copied, "duration_seconds": round(duration, 3)}
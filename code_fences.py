@@ -0,0 +1,64 @@
+# code_fences.py
+# --- Markdown Code Fence Stripping ---
+
+FENCE = "```"
+
+
+class CodeFenceStripper:
+    """
+    Incrementally strip the Markdown fence wrapping a generated code block.
+
+    Text is fed piece by piece as it arrives from the model. If the output
+    starts with a fence, the opening fence line and the last non-blank line
+    (the closing fence) are dropped; otherwise the text is passed through
+    unchanged. Only the current tail line is held back, so code is released
+    as soon as each line is complete.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._fenced = None  # None tant que le début du texte ne permet pas de décider.
+        self._in_header = True
+
+    def feed(self, text: str) -> str:
+        """Consume a piece of model output and return the code that can be emitted."""
+        self._pending += text
+
+        if self._fenced is None:
+            head = self._pending.lstrip()
+            if len(head) < len(FENCE) and FENCE.startswith(head):
+                return ""
+            self._fenced = head.startswith(FENCE)
+
+        if not self._fenced:
+            out, self._pending = self._pending, ""
+            return out
+
+        if self._in_header:
+            newline = self._pending.find("\n", self._pending.find(FENCE))
+            if newline == -1:
+                return ""
+            self._pending = self._pending[newline + 1:]
+            self._in_header = False
+
+        # Retenir la dernière ligne non vide et le saut de ligne qui la précède : c'est peut-être la clôture.
+        last_line_start = self._pending.rfind("\n", 0, len(self._pending.rstrip()))
+        if last_line_start == -1:
+            return ""
+        out, self._pending = self._pending[:last_line_start], self._pending[last_line_start:]
+        return out
+
+    def flush(self) -> str:
+        """Return whatever remains once the model output is complete."""
+        if self._fenced:
+            # La ligne retenue est la clôture : elle est abandonnée.
+            self._pending = ""
+            return ""
+        out, self._pending = self._pending, ""
+        return out
+
+
+def strip_code_fences(text: str) -> str:
+    """Strip the Markdown fence wrapping a complete generated code block."""
+    stripper = CodeFenceStripper()
+    return stripper.feed(text) + stripper.flush()
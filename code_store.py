@@ -0,0 +1,157 @@
+# code_store.py
+# --- Imports ---
+import json
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+import redis
+from firebase_admin import firestore
+
+# --- Logging Configuration ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Generated Code Hand-off Store ---
+
+# Durée de vie par défaut d'un code généré non téléchargé (1 heure).
+DEFAULT_TTL_SECONDS = 3600
+REDIS_KEY_PREFIX = "code_handoff:"
+FIRESTORE_COLLECTION = "generated_codes"
+# Préfixe des IDs écrits dans le stockage de secours, pour y router directement les téléchargements.
+FALLBACK_ID_PREFIX = "fb-"
+
+
+class CodeStore(ABC):
+    """
+    One-shot, expiring storage for generated code between generation and download.
+
+    `put` stores an artifact for `ttl_seconds` and returns the code ID to hand to
+    the client; `take` returns the artifact and removes it atomically, so each
+    code ID can be downloaded exactly once.
+    """
+
+    def __init__(self, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+
+    @abstractmethod
+    def put(self, code_id: str, code: str, filename: str) -> str:
+        """Store an artifact and return the code ID under which it can be taken."""
+
+    @abstractmethod
+    def take(self, code_id: str) -> dict | None:
+        """Return and delete the artifact, or None if it is missing or expired."""
+
+
+class RedisCodeStore(CodeStore):
+    """Hand-off store backed by Redis keys with an expiry and an atomic GETDEL."""
+
+    def __init__(self, redis_client: redis.Redis, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.redis_client = redis_client
+
+    def put(self, code_id: str, code: str, filename: str):
+        payload = json.dumps({'code': code, 'filename': filename})
+        self.redis_client.set(f"{REDIS_KEY_PREFIX}{code_id}", payload, ex=self.ttl_seconds)
+        return code_id
+
+    def take(self, code_id: str) -> dict | None:
+        key = f"{REDIS_KEY_PREFIX}{code_id}"
+        try:
+            payload = self.redis_client.getdel(key)
+        except redis.exceptions.ResponseError:
+            # GETDEL n'existe qu'à partir de Redis 6.2 : on retombe sur une transaction GET + DEL.
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.get(key)
+            pipe.delete(key)
+            payload, _ = pipe.execute()
+        return json.loads(payload) if payload else None
+
+
+class FirestoreCodeStore(CodeStore):
+    """
+    Hand-off store backed by the Firestore `generated_codes` collection.
+
+    Each document carries an `expiresAt` timestamp used by the Firestore TTL
+    policy (see firestore.indexes.json) to delete abandoned codes. Because TTL
+    deletion is not immediate, expired documents are also rejected on read.
+    """
+
+    def __init__(self, db, ttl_seconds: int = DEFAULT_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.db = db
+
+    def put(self, code_id: str, code: str, filename: str):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        self.db.collection(FIRESTORE_COLLECTION).document(code_id).set({
+            'code': code,
+            'filename': filename,
+            'createdAt': firestore.SERVER_TIMESTAMP,
+            'expiresAt': expires_at,
+        })
+        return code_id
+
+    def take(self, code_id: str) -> dict | None:
+        doc_ref = self.db.collection(FIRESTORE_COLLECTION).document(code_id)
+
+        @firestore.transactional
+        def _take(transaction):
+            doc = doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return None
+            transaction.delete(doc_ref)
+            return doc.to_dict()
+
+        data = _take(self.db.transaction())
+        if not data:
+            return None
+        expires_at = data.get('expiresAt')
+        if expires_at and expires_at < datetime.now(timezone.utc):
+            return None
+        return {'code': data.get('code', ''), 'filename': data.get('filename')}
+
+
+class FallbackCodeStore(CodeStore):
+    """
+    Writes to a primary store, falling back to a secondary one when the primary fails.
+
+    Artifacts written to the fallback get an ID prefixed with `FALLBACK_ID_PREFIX`,
+    so downloads go straight to the store that holds them: a miss on the primary
+    (unknown, expired or already downloaded ID) never costs a fallback lookup.
+    """
+
+    def __init__(self, primary: CodeStore, fallback: CodeStore):
+        super().__init__(primary.ttl_seconds)
+        self.primary = primary
+        self.fallback = fallback
+
+    def put(self, code_id: str, code: str, filename: str) -> str:
+        try:
+            return self.primary.put(code_id, code, filename)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Primary code store unavailable (put): {e}. Falling back.")
+            return FALLBACK_ID_PREFIX + self.fallback.put(code_id, code, filename)
+
+    def take(self, code_id: str) -> dict | None:
+        if code_id.startswith(FALLBACK_ID_PREFIX):
+            return self.fallback.take(code_id[len(FALLBACK_ID_PREFIX):])
+        return self.primary.take(code_id)
+
+
+def build_code_store(redis_client, db, ttl_seconds: int = DEFAULT_TTL_SECONDS) -> CodeStore | None:
+    """
+    Build the hand-off store from the available backends.
+
+    Redis is the primary store and Firestore the fallback; if only one of them
+    is available it is used alone. Returns None if neither is available.
+    """
+    stores = []
+    if redis_client:
+        stores.append(RedisCodeStore(redis_client, ttl_seconds))
+    if db:
+        stores.append(FirestoreCodeStore(db, ttl_seconds))
+    if not stores:
+        return None
+    if len(stores) == 1:
+        return stores[0]
+    return FallbackCodeStore(*stores)
+
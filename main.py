@@ -1,24 +1,29 @@
 # main.py
 # --- Imports ---
 import os
+import asyncio
+import contextlib
 import uvicorn
-import shutil
 import uuid
 import json
 import re
+import math
 import tempfile
 import subprocess
 import logging
 from dotenv import load_dotenv
 import google.generativeai as genai
-from fastapi import FastAPI, HTTPException, UploadFile, File, Response, Depends, Request
+from fastapi import FastAPI, HTTPException, UploadFile, File, Response, Depends, Request, Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, HttpUrl
 import firebase_admin
 from firebase_admin import credentials, firestore
-from pypdf import PdfReader
 from google.cloud import secretmanager
 import chroma_service
+import upload_service
+import code_store
+import code_fences
+import upstream_client
 from auth import verify_token, verify_admin
 import redis
 import hashlib
@@ -57,6 +62,13 @@ try:
     GCP_REGION = os.environ.get("GCP_REGION")
     REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
     REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+    MAX_UPLOAD_SIZE_BYTES = int(os.environ.get("MAX_UPLOAD_SIZE_BYTES", 5 * 1024 * 1024))
+    GENERATED_CODE_TTL_SECONDS = int(os.environ.get("GENERATED_CODE_TTL_SECONDS", code_store.DEFAULT_TTL_SECONDS))
+    GEMINI_EMBED_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_EMBED_TIMEOUT_SECONDS", 30))
+    GEMINI_GENERATE_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_GENERATE_TIMEOUT_SECONDS", 60))
+    GEMINI_STREAM_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_STREAM_TIMEOUT_SECONDS", 300))
+    GEMINI_EMBED_HEDGE_DELAY_SECONDS = float(os.environ.get("GEMINI_EMBED_HEDGE_DELAY_SECONDS", 0.5))
+    BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", 4))
 
 
     # Récupérer le nom de la ressource du secret depuis les variables d'environnement
@@ -107,7 +119,49 @@ except redis.exceptions.ConnectionError as e:
     logger.warning(f"ERREUR: Impossible de se connecter à Redis. Le caching sera désactivé. Détails: {e}")
     redis_client = None
 
-# 5. Initialisation du Rate Limiter
+# 5. Initialisation du stockage du code généré (Redis en primaire, Firestore en secours)
+generated_code_store = code_store.build_code_store(redis_client, db, GENERATED_CODE_TTL_SECONDS)
+
+# 6. Initialisation des clients upstream Gemini (délais, retries, disjoncteur, concurrence adaptative)
+# Les embeddings sont idempotents : ils peuvent être retentés et couverts (hedging). Les générations ne le sont pas.
+# Le temps restant avant l'échéance est transmis à genai, qui abandonne ainsi lui-même une requête bloquée.
+# Chaque client a son propre limiteur : la latence n'est un signal de santé qu'entre appels comparables.
+def gemini_request_options(remaining: float) -> dict:
+    return {"request_options": {"timeout": remaining}}
+
+# Embeddings des questions du chat (quelques textes, ~100 ms) : sensibles à la latence, donc couverts.
+embedding_upstream = upstream_client.UpstreamClient(
+    "gemini-embeddings",
+    timeout=GEMINI_EMBED_TIMEOUT_SECONDS,
+    max_retries=2,
+    hedge_delay=GEMINI_EMBED_HEDGE_DELAY_SECONDS or None,
+    timeout_kwargs=gemini_request_options,
+)
+# Embeddings des documents uploadés, par lots de EMBEDDING_BATCH_SIZE fragments.
+document_embedding_upstream = upstream_client.UpstreamClient(
+    "gemini-document-embeddings",
+    timeout=GEMINI_EMBED_TIMEOUT_SECONDS,
+    max_retries=2,
+    timeout_kwargs=gemini_request_options,
+)
+# Générations complètes : leur durée dépend de la longueur de la réponse, seules les erreurs ajustent la concurrence.
+generation_upstream = upstream_client.UpstreamClient(
+    "gemini-generation",
+    timeout=GEMINI_GENERATE_TIMEOUT_SECONDS,
+    max_retries=0,
+    timeout_kwargs=gemini_request_options,
+    limiter=upstream_client.AdaptiveConcurrencyLimiter(latency_tolerance=None),
+)
+# Générations en flux : la latence mesurée est celle du premier fragment.
+generation_stream_upstream = upstream_client.UpstreamClient(
+    "gemini-generation-stream",
+    timeout=GEMINI_GENERATE_TIMEOUT_SECONDS,
+    max_retries=0,
+    stream_timeout=GEMINI_STREAM_TIMEOUT_SECONDS,
+    timeout_kwargs=gemini_request_options,
+)
+
+# 7. Initialisation du Rate Limiter
 limiter = Limiter(key_func=get_remote_address, storage_uri=f"redis://{REDIS_HOST}:{REDIS_PORT}" if redis_client else "memory://")
 
 
@@ -121,14 +175,31 @@ class ChatResponse(BaseModel):
     reply: str = Field(..., title="Reply")
     session_id: str = Field(title="Session ID")
 
+# Le nom de fichier est renvoyé tel quel dans le trailer du flux (`__CODE_ID__::<id>::<filename>`) et dans
+# l'en-tête Content-Disposition : ni caractère de contrôle (dont les sauts de ligne), ni ":", guillemet ou séparateur de chemin.
+FILENAME_PATTERN = r'^[^\x00-\x1f\x7f:"/\\]+$'
+
 class CodeGenerationRequest(BaseModel):
     prompt: str = Field(..., title="Description du code à générer", max_length=5000)
-    filename: str = Field("script.py", title="Nom de fichier suggéré pour le téléchargement")
+    filename: str = Field("script.py", title="Nom de fichier suggéré pour le téléchargement", max_length=255, pattern=FILENAME_PATTERN)
 
 class CodeGenerationResponse(BaseModel):
     code_id: str = Field(..., title="ID unique pour récupérer le code généré")
     filename: str = Field(..., title="Nom de fichier à utiliser pour le téléchargement")
 
+# Chaque élément d'un lot est décompté par le rate limiter : un lot ne doit pas dépasser la limite
+# par minute la plus basse des endpoints unitaires (30/minute pour la génération de code).
+BATCH_MAX_ITEMS = 20
+
+class BatchChatRequest(BaseModel):
+    items: list[ChatRequest] = Field(..., title="Requêtes de chat", min_length=1, max_length=BATCH_MAX_ITEMS)
+
+class BatchCodeGenerationRequest(BaseModel):
+    items: list[CodeGenerationRequest] = Field(..., title="Requêtes de génération de code", min_length=1, max_length=BATCH_MAX_ITEMS)
+
+class DeleteSourcesRequest(BaseModel):
+    source_files: list[str] = Field(..., title="Fichiers sources dont les fragments sont à supprimer", min_length=1)
+
 # --- Initialisation de FastAPI ---
 app = FastAPI(
     title="Jules.google Backend API",
@@ -137,6 +208,12 @@ app = FastAPI(
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Les uploads trop volumineux sont refusés avant l'analyse du corps multipart.
+app.add_middleware(
+    upload_service.UploadSizeLimitMiddleware,
+    paths=["/api/upload"],
+    max_body_bytes=MAX_UPLOAD_SIZE_BYTES + upload_service.MULTIPART_OVERHEAD_BYTES,
+)
 
 
 # --- Initialisation du Modèle Gemini ---
@@ -148,57 +225,81 @@ model = genai.GenerativeModel('gemini-1.5-flash-latest')
 async def read_root():
     return {"status": "ok", "message": "Backend de Jules.google v0.7.0 avec RAG (ChromaDB)."}
 
+# Nombre maximal de textes par requête d'embedding (limite de batchEmbedContents).
+EMBEDDING_BATCH_SIZE = 100
+
 @app.post("/api/upload", tags=["Knowledge"])
 @limiter.limit("20/minute")
 async def upload_knowledge(request: Request, file: UploadFile = File(...), token: dict = Depends(verify_token)):
     if not chroma_service.is_ready() or not db:
         raise HTTPException(status_code=503, detail="Un service backend (ChromaDB ou Firestore) n'est pas disponible.")
 
-    temp_dir = "temp_uploads"
-    os.makedirs(temp_dir, exist_ok=True)
-    file_path = os.path.join(temp_dir, file.filename)
+    # Le nom fourni par le client ne sert qu'à l'identification, jamais de chemin sur disque.
+    filename = os.path.basename(file.filename or "")
+    if filename.endswith(".pdf"):
+        extract_text = upload_service.iter_pdf_text
+    elif filename.endswith(".txt"):
+        extract_text = upload_service.iter_txt_text
+    else:
+        raise HTTPException(status_code=400, detail="Type de fichier non supporté. Uniquement .txt et .pdf.")
+
+    # Le corps a déjà été borné par UploadSizeLimitMiddleware ; on vérifie ici la taille exacte du fichier.
+    # Starlette a placé le fichier dans un SpooledTemporaryFile (mémoire, puis fichier temporaire privé au-delà de 1 Mo) :
+    # on l'analyse directement, sans autre copie.
+    file_size = file.size if file.size is not None else upload_service.get_upload_size(file.file)
+    if file_size > MAX_UPLOAD_SIZE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Le fichier dépasse la taille maximale autorisée de {MAX_UPLOAD_SIZE_BYTES} octets.")
 
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        text = ""
-        if file.filename.endswith(".pdf"):
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        elif file.filename.endswith(".txt"):
-            with open(file_path, "r", encoding='utf-8') as f:
-                text = f.read()
-        else:
-            raise HTTPException(status_code=400, detail="Type de fichier non supporté. Uniquement .txt et .pdf.")
+        # Inutile de calculer des embeddings qui seraient refusés à l'écriture.
+        if chroma_service.is_reindexing():
+            raise chroma_service.ReindexInProgressError()
 
-        chunk_size = 1000
-        overlap = 200
-        chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size - overlap)]
+        file.file.seek(0)
+        chunks = list(upload_service.iter_text_chunks(extract_text(file.file), chunk_size=1000, overlap=200))
 
         if not chunks:
-            return {"filename": file.filename, "status": "no_content", "message": "Le fichier ne contenait aucun texte à traiter."}
+            return {"filename": filename, "status": "no_content", "message": "Le fichier ne contenait aucun texte à traiter."}
 
-        embedding_result = genai.embed_content(model="models/text-embedding-004", content=chunks, task_type="RETRIEVAL_DOCUMENT")
-        embeddings = embedding_result['embedding']
+        # Un appel par lot : chaque lot a son propre délai, et une nouvelle tentative ne refait que ce lot.
+        embeddings = []
+        for i in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+            embedding_result = await document_embedding_upstream.call(genai.embed_content, model="models/text-embedding-004", content=chunks[i:i + EMBEDDING_BATCH_SIZE], task_type="RETRIEVAL_DOCUMENT", idempotent=True)
+            embeddings.extend(embedding_result['embedding'])
 
         # Préparer les données pour ChromaDB
-        ids = [f"{os.path.splitext(file.filename)[0]}-{uuid.uuid4()}" for _ in chunks]
-        metadatas = [{"source_file": file.filename} for _ in chunks]
+        ids = [f"{os.path.splitext(filename)[0]}-{uuid.uuid4()}" for _ in chunks]
+        metadatas = [{"source_file": filename} for _ in chunks]
 
-        # Insérer les documents dans ChromaDB
-        chroma_service.upsert_documents(
+        # Insérer les documents dans ChromaDB (hors de la boucle d'événements ; refusé si une réindexation a commencé entre-temps)
+        await asyncio.to_thread(
+            chroma_service.upsert_documents,
             datapoint_ids=ids,
             documents=chunks,
             embeddings=embeddings,
             metadatas=metadatas
         )
 
-        return {"filename": file.filename, "status": "processed", "chunks_added": len(chunks)}
+        return {"filename": filename, "status": "processed", "chunks_added": len(chunks)}
+    except HTTPException:
+        raise
+    except UnicodeDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Le fichier texte n'est pas encodé en UTF-8 valide: {e}")
+    except upstream_client.UpstreamUnavailableError as e:
+        logger.warning(f"Appel aux embeddings Gemini refusé localement: {e}")
+        raise HTTPException(status_code=503, detail=f"L'API Google (Gemini Embeddings) est temporairement indisponible: {e}", headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except upstream_client.UpstreamTimeoutError as e:
+        logger.error(f"Délai dépassé pour l'API Google (Gemini Embeddings): {e}")
+        raise HTTPException(status_code=504, detail=f"Délai dépassé pour l'API Google (Gemini Embeddings): {e}")
+    except google_exceptions.TooManyRequests as e:
+        logger.warning(f"Quota de l'API Google (Gemini Embeddings) dépassé: {e}")
+        raise HTTPException(status_code=429, detail=f"Quota de l'API Google (Gemini Embeddings) dépassé: {e}")
     except google_exceptions.GoogleAPICallError as e:
         logger.error(f"Erreur de communication avec l'API Google (Gemini Embeddings): {e}")
         raise HTTPException(status_code=502, detail=f"Erreur de communication avec l'API Google (Gemini Embeddings): {e}")
+    except chroma_service.ReindexInProgressError as e:
+        logger.warning(f"Upload refusé pendant la réindexation de ChromaDB: {e}")
+        raise HTTPException(status_code=503, detail="La base de connaissances est en cours de réindexation, réessayez plus tard.", headers={"Retry-After": str(e.retry_after)})
     except ConnectionError as e:
         logger.error(f"Erreur de communication avec ChromaDB: {e}")
         raise HTTPException(status_code=503, detail=f"Erreur de communication avec ChromaDB: {e}")
@@ -208,55 +309,116 @@ async def upload_knowledge(request: Request, file: UploadFile = File(...), token
     except Exception as e:
         logger.error(f"Erreur inattendue lors du traitement de l'upload: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur inattendue lors du traitement du fichier: {str(e)}")
+
+def get_code_cache_key(user_prompt: str) -> str:
+    """Return the Redis key under which the code generated for a prompt is cached."""
+    return f"code_gen:{hashlib.sha256(user_prompt.encode()).hexdigest()}"
+
+async def count_batch_items(request: Request):
+    """
+    Records the number of items of a batch request so that the rate limiter charges each of them.
+
+    FastAPI has already read the body, so `request.json()` does not consume it again.
+    """
+    try:
+        body = await request.json()
+        request.state.batch_items = max(1, len(body.get("items") or []))
+    except (ValueError, AttributeError):
+        request.state.batch_items = 1
+
+def batch_item_cost(request: Request) -> int:
+    """Rate-limit cost of a batch request: one hit per item, as for the single-item endpoints."""
+    return getattr(request.state, "batch_items", 1)
+
+async def stream_batch_results(jobs):
+    """
+    An async generator that runs batch jobs with bounded parallelism and streams their results as NDJSON.
+
+    Each job is an `(indices, fn)` pair: `fn` is a coroutine function that returns a
+    dict mapping each item index to its result payload. Lines
+    are emitted in completion order; a failed job yields an error line per index.
+    """
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def run(indices, fn):
+        async with semaphore:
+            try:
+                return indices, await fn(), None
+            except Exception as e:
+                logger.error(f"Batch item failed: {e}")
+                return indices, None, e
+
+    tasks = [asyncio.create_task(run(indices, fn)) for indices, fn in jobs]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indices, results, error = await next_done
+            for index in indices:
+                if error is not None:
+                    line = {"index": index, "status": "error", "detail": str(error)}
+                else:
+                    line = {"index": index, "status": "ok", **results[index]}
+                yield json.dumps(line) + "\n"
     finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        for task in tasks:
+            task.cancel()
+
+def build_code_generation_prompt(user_prompt: str) -> str:
+    """Wrap the user's request in the instructions used for code generation."""
+    return f"""
+    Ta tâche est de générer uniquement le code source pour la demande suivante.
+    Ne fournis AUCUNE explication, commentaire en langage naturel, ou formatage de type Markdown avant ou après le bloc de code.
+    Le résultat doit être directement compilable ou interprétable.
+    Demande de l'utilisateur : "{user_prompt}"
+    """
+
+async def generate_code_text(user_prompt: str, cache_key: str) -> str:
+    """Generate code for a prompt, strip its Markdown fences and cache the result."""
+    response = await generation_upstream.call(model.generate_content, build_code_generation_prompt(user_prompt))
+    generated_code = code_fences.strip_code_fences(response.text)
+
+    try:
+        if redis_client:
+            redis_client.set(cache_key, json.dumps({'code': generated_code}), ex=86400)  # Cache pour 24 heures
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Erreur Redis (SET): {e}. La réponse est envoyée mais non cachée.")
+
+    return generated_code
 
 @app.post("/api/generate-code", response_model=CodeGenerationResponse, tags=["Code Generation"])
 @limiter.limit("30/minute")
 async def generate_code(request: Request, req_body: CodeGenerationRequest, token: dict = Depends(verify_token)):
-    if not db:
-        raise HTTPException(status_code=503, detail="La connexion à Firestore n'est pas disponible.")
+    if not generated_code_store:
+        raise HTTPException(status_code=503, detail="Aucun stockage (Redis ou Firestore) n'est disponible pour le code généré.")
 
-    cache_key = f"code_gen:{hashlib.sha256(req_body.prompt.encode()).hexdigest()}"
+    # Le cache conserve le code lui-même : chaque hit produit un nouvel ID téléchargeable.
+    cache_key = get_code_cache_key(req_body.prompt)
+    generated_code = None
     try:
         if redis_client:
             cached_result = redis_client.get(cache_key)
             if cached_result:
                 logger.info(f"Cache HIT for prompt: '{req_body.prompt[:50]}...'")
-                cached_data = json.loads(cached_result)
-                return CodeGenerationResponse(**cached_data)
+                generated_code = json.loads(cached_result).get('code')
     except redis.exceptions.RedisError as e:
         logger.warning(f"Erreur Redis (GET): {e}. On continue sans cache.")
 
-    logger.info(f"Cache MISS for prompt: '{req_body.prompt[:50]}...'")
-    code_generation_prompt = f"""
-    Ta tâche est de générer uniquement le code source pour la demande suivante.
-    Ne fournis AUCUNE explication, commentaire en langage naturel, ou formatage de type Markdown avant ou après le bloc de code.
-    Le résultat doit être directement compilable ou interprétable.
-    Demande de l'utilisateur : "{req_body.prompt}"
-    """
     try:
-        response = model.generate_content(code_generation_prompt)
-        generated_code = response.text
-
-        if generated_code.strip().startswith("```"):
-            lines = generated_code.strip().split('\n')
-            generated_code = '\n'.join(lines[1:-1])
-
-        code_id = str(uuid.uuid4())
-        doc_ref = db.collection('generated_codes').document(code_id)
-        doc_ref.set({'code': generated_code, 'filename': req_body.filename, 'createdAt': firestore.SERVER_TIMESTAMP})
-
-        response_data = {"code_id": code_id, "filename": req_body.filename}
-
-        try:
-            if redis_client:
-                redis_client.set(cache_key, json.dumps(response_data), ex=86400)  # Cache pour 24 heures
-        except redis.exceptions.RedisError as e:
-            logger.warning(f"Erreur Redis (SET): {e}. La réponse est envoyée mais non cachée.")
-
-        return CodeGenerationResponse(**response_data)
+        if generated_code is None:
+            logger.info(f"Cache MISS for prompt: '{req_body.prompt[:50]}...'")
+            generated_code = await generate_code_text(req_body.prompt, cache_key)
+
+        code_id = generated_code_store.put(str(uuid.uuid4()), generated_code, req_body.filename)
+
+        return CodeGenerationResponse(code_id=code_id, filename=req_body.filename)
+    except upstream_client.UpstreamUnavailableError as e:
+        logger.warning(f"Appel à l'API Gemini refusé localement: {e}")
+        raise HTTPException(status_code=503, detail=f"L'API Gemini est temporairement indisponible: {e}", headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except upstream_client.UpstreamTimeoutError as e:
+        logger.error(f"Délai dépassé pour l'API Gemini: {e}")
+        raise HTTPException(status_code=504, detail=f"Délai dépassé pour l'API Gemini: {e}")
+    except google_exceptions.TooManyRequests as e:
+        logger.warning(f"Quota de l'API Gemini dépassé: {e}")
+        raise HTTPException(status_code=429, detail=f"Quota de l'API Gemini dépassé: {e}")
     except google_exceptions.GoogleAPICallError as e:
         logger.error(f"Erreur lors de la communication avec l'API Gemini: {e}")
         raise HTTPException(status_code=502, detail=f"Erreur lors de la communication avec l'API Gemini: {e}")
@@ -264,29 +426,128 @@ async def generate_code(request: Request, req_body: CodeGenerationRequest, token
         logger.error(f"Erreur inattendue lors de la génération du code: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur inattendue lors de la génération du code: {e}")
 
-@app.get("/api/download-code/{code_id}", tags=["Code Generation"])
-@limiter.limit("60/minute")
-async def download_code(request: Request, code_id: str, filename: str, token: dict = Depends(verify_token)):
-    if not db:
-        raise HTTPException(status_code=503, detail="La connexion à Firestore n'est pas disponible.")
+async def stream_code_generation(user_prompt, filename, cache_key, code_id):
+    """
+    An async generator that streams generated code as it arrives, then stores and caches the final artifact.
 
+    The stream always ends with a trailer on its own line: `__CODE_ID__::<id>::<filename>`
+    once the code is stored and downloadable, or `__ERROR__::<message>` on failure.
+    """
     try:
-        doc_ref = db.collection('generated_codes').document(code_id)
-        doc = doc_ref.get()
+        generated_code = None
+        try:
+            if redis_client:
+                cached_result = redis_client.get(cache_key)
+                if cached_result:
+                    logger.info(f"Cache HIT for prompt: '{user_prompt[:50]}...'")
+                    generated_code = json.loads(cached_result).get('code')
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Erreur Redis (GET): {e}. On continue sans cache.")
+
+        if generated_code is not None:
+            yield generated_code
+        else:
+            logger.info(f"Cache MISS for prompt: '{user_prompt[:50]}...'")
+            stripper = code_fences.CodeFenceStripper()
+            parts = []
+            response_stream = generation_stream_upstream.stream(model.generate_content, build_code_generation_prompt(user_prompt), stream=True)
+            async with contextlib.aclosing(response_stream):
+                async for chunk in response_stream:
+                    if chunk.text:
+                        code = stripper.feed(chunk.text)
+                        if code:
+                            parts.append(code)
+                            yield code
+            code = stripper.flush()
+            if code:
+                parts.append(code)
+                yield code
+            generated_code = "".join(parts)
+
+            try:
+                if redis_client:
+                    redis_client.set(cache_key, json.dumps({'code': generated_code}), ex=86400)  # Cache pour 24 heures
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Erreur Redis (SET): {e}. Le code est envoyé mais non caché.")
+
+        # Only a complete generation is persisted: a failed stream leaves nothing to download.
+        code_id = generated_code_store.put(code_id, generated_code, filename)
+        logger.info(f"Streamed code generation finished. Code length: {len(generated_code)}")
+        yield f"\n__CODE_ID__::{code_id}::{filename}\n"
+    except Exception as e:
+        logger.error(f"Error during streaming code generation: {e}")
+        message = " ".join(str(e).split())
+        yield f"\n__ERROR__::{message}\n"
+
+@app.post("/api/generate-code/stream", tags=["Code Generation"])
+@limiter.limit("30/minute")
+async def generate_code_stream(request: Request, req_body: CodeGenerationRequest, token: dict = Depends(verify_token)):
+    if not generated_code_store:
+        raise HTTPException(status_code=503, detail="Aucun stockage (Redis ou Firestore) n'est disponible pour le code généré.")
 
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="Code non trouvé, expiré, ou déjà téléchargé.")
+    cache_key = get_code_cache_key(req_body.prompt)
+    code_id = str(uuid.uuid4())
 
-        code_data = doc.to_dict()
-        generated_code = code_data.get('code', '')
+    return StreamingResponse(
+        stream_code_generation(req_body.prompt, req_body.filename, cache_key, code_id),
+        media_type="text/plain"
+    )
 
-        response = Response(content=generated_code, media_type="application/octet-stream", headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+@app.post("/api/generate-code/batch", tags=["Code Generation"], dependencies=[Depends(count_batch_items)])
+@limiter.limit("30/minute", cost=batch_item_cost)
+async def generate_code_batch(request: Request, req_body: BatchCodeGenerationRequest, token: dict = Depends(verify_token)):
+    """
+    Generates code for several prompts and streams one NDJSON line per item, in completion order.
+
+    Identical prompts are generated once; every item still gets its own download ID.
+    """
+    if not generated_code_store:
+        raise HTTPException(status_code=503, detail="Aucun stockage (Redis ou Firestore) n'est disponible pour le code généré.")
+
+    indices_by_prompt = {}
+    for index, item in enumerate(req_body.items):
+        indices_by_prompt.setdefault(item.prompt, []).append(index)
+    prompts = list(indices_by_prompt)
+    cache_keys = [get_code_cache_key(prompt) for prompt in prompts]
+
+    cached_codes = [None] * len(prompts)
+    try:
+        if redis_client:
+            cached_results = await asyncio.to_thread(redis_client.mget, cache_keys)
+            cached_codes = [json.loads(result).get('code') if result else None for result in cached_results]
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Erreur Redis (MGET): {e}. On continue sans cache.")
+
+    def make_job(prompt, cache_key, cached_code, indices):
+        async def job():
+            generated_code = cached_code if cached_code is not None else await generate_code_text(prompt, cache_key)
+            results = {}
+            for index in indices:
+                filename = req_body.items[index].filename
+                code_id = await asyncio.to_thread(generated_code_store.put, str(uuid.uuid4()), generated_code, filename)
+                results[index] = {"code_id": code_id, "filename": filename}
+            return results
+        return job
+
+    jobs = [
+        (indices_by_prompt[prompt], make_job(prompt, cache_key, cached_code, indices_by_prompt[prompt]))
+        for prompt, cache_key, cached_code in zip(prompts, cache_keys, cached_codes)
+    ]
+    logger.info(f"Code generation batch: {len(req_body.items)} items, {len(prompts)} unique prompts, {sum(code is not None for code in cached_codes)} cache hits.")
+    return StreamingResponse(stream_batch_results(jobs), media_type="application/x-ndjson")
 
-        doc_ref.delete()
+@app.get("/api/download-code/{code_id}", tags=["Code Generation"])
+@limiter.limit("60/minute")
+async def download_code(request: Request, code_id: str, filename: str = Query(..., max_length=255, pattern=FILENAME_PATTERN), token: dict = Depends(verify_token)):
+    if not generated_code_store:
+        raise HTTPException(status_code=503, detail="Aucun stockage (Redis ou Firestore) n'est disponible pour le code généré.")
 
-        return response
-    except google_exceptions.NotFound:
-         raise HTTPException(status_code=404, detail="Le document de code n'a pas été trouvé dans Firestore.")
+    try:
+        # Lecture et suppression atomiques : un code ne peut être téléchargé qu'une fois.
+        code_data = generated_code_store.take(code_id)
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Erreur de communication avec Redis: {e}")
+        raise HTTPException(status_code=503, detail=f"Le stockage du code généré (Redis) est temporairement indisponible: {e}")
     except google_exceptions.GoogleAPICallError as e:
         logger.error(f"Erreur de communication avec Firestore: {e}")
         raise HTTPException(status_code=502, detail=f"Erreur de communication avec Firestore: {e}")
@@ -294,20 +555,31 @@ async def download_code(request: Request, code_id: str, filename: str, token: di
         logger.error(f"Erreur inattendue lors du téléchargement du code: {e}")
         raise HTTPException(status_code=500, detail=f"Erreur inattendue: {e}")
 
+    if code_data is None:
+        raise HTTPException(status_code=404, detail="Code non trouvé, expiré, ou déjà téléchargé.")
+
+    # Le code tient en un seul document (moins de 1 Mio avec le secours Firestore) : il est renvoyé d'un bloc.
+    return Response(
+        content=code_data.get('code', ''),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 async def stream_chat_response(chat_session, augmented_prompt, messages_ref, user_prompt, parent_id, session_ref, user_message_id, model_message_id):
     """
     An async generator that streams the chat response and saves the full conversation with versioning.
     """
+    full_reply = ""
     try:
         # First, yield the IDs to the client
         yield f"__IDS__::{user_message_id}::{model_message_id}\n"
 
-        response_stream = chat_session.send_message(augmented_prompt, stream=True)
-        full_reply = ""
-        for chunk in response_stream:
-            if chunk.text:
-                full_reply += chunk.text
-                yield chunk.text
+        response_stream = generation_stream_upstream.stream(chat_session.send_message, augmented_prompt, stream=True)
+        async with contextlib.aclosing(response_stream):
+            async for chunk in response_stream:
+                if chunk.text:
+                    full_reply += chunk.text
+                    yield chunk.text
     except Exception as e:
         logger.error(f"Error during streaming response generation: {e}")
         yield f"ERREUR: {str(e)}"
@@ -315,31 +587,37 @@ async def stream_chat_response(chat_session, augmented_prompt, messages_ref, use
         logger.info(f"Streaming finished. Full reply length: {len(full_reply)}")
         if full_reply:
             try:
-                user_message_doc = {
-                    'message_id': user_message_id,
-                    'parent_id': parent_id,
-                    'role': 'user',
-                    'parts': [user_prompt],
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                }
-                model_message_doc = {
-                    'message_id': model_message_id,
-                    'parent_id': user_message_id,
-                    'role': 'model',
-                    'parts': [full_reply],
-                    'timestamp': firestore.SERVER_TIMESTAMP
-                }
-
-                batch = db.batch()
-                batch.set(messages_ref.document(user_message_id), user_message_doc)
-                batch.set(messages_ref.document(model_message_id), model_message_doc)
-                batch.set(session_ref, {'latest_message_id': model_message_id}, merge=True)
-                batch.commit()
-
-                logger.info("Chat history successfully saved to Firestore with versioning.")
+                save_chat_turn(messages_ref, session_ref, parent_id, user_message_id, model_message_id, user_prompt, full_reply)
             except Exception as e:
                 logger.error(f"Failed to save versioned chat history to Firestore: {e}")
 
+def save_chat_turn(messages_ref, session_ref, parent_id, user_message_id, model_message_id, user_prompt, reply):
+    """
+    Saves a user message and the model's reply as a new versioned turn of the session.
+    """
+    user_message_doc = {
+        'message_id': user_message_id,
+        'parent_id': parent_id,
+        'role': 'user',
+        'parts': [user_prompt],
+        'timestamp': firestore.SERVER_TIMESTAMP
+    }
+    model_message_doc = {
+        'message_id': model_message_id,
+        'parent_id': user_message_id,
+        'role': 'model',
+        'parts': [reply],
+        'timestamp': firestore.SERVER_TIMESTAMP
+    }
+
+    batch = db.batch()
+    batch.set(messages_ref.document(user_message_id), user_message_doc)
+    batch.set(messages_ref.document(model_message_id), model_message_doc)
+    batch.set(session_ref, {'latest_message_id': model_message_id}, merge=True)
+    batch.commit()
+
+    logger.info("Chat history successfully saved to Firestore with versioning.")
+
 def get_history_for_branch(messages_ref, leaf_message_id):
     """
     Constructs the conversation history for a specific branch by traversing parent_id.
@@ -369,6 +647,65 @@ def get_history_for_branch(messages_ref, leaf_message_id):
 
     return history
 
+async def retrieve_contexts(prompts: list[str], hedge: bool = False) -> list[str]:
+    """
+    Retrieves the RAG context for each prompt, with a single embedding call for all of them.
+
+    Returns one context string per prompt; contexts are empty if ChromaDB is
+    unavailable or the search fails, so callers can continue without context.
+    """
+    contexts = [""] * len(prompts)
+    if not prompts or not chroma_service.is_ready():
+        return contexts
+
+    try:
+        embedding_result = await embedding_upstream.call(genai.embed_content, model="models/text-embedding-004", content=prompts, task_type="RETRIEVAL_QUERY", idempotent=True, hedge=hedge)
+        search_results = await asyncio.to_thread(chroma_service.query_collection_batch, query_embeddings=embedding_result['embedding'], num_results=3)
+
+        # Les documents sont directement dans la réponse de ChromaDB
+        for i, documents in enumerate(search_results.get('documents') or []):
+            if documents:
+                contexts[i] = "\n---\n".join(documents)
+    except Exception as e:
+        logger.error(f"Erreur pendant la recherche RAG avec ChromaDB: {e}")
+        # On continue sans contexte en cas d'erreur
+    return contexts
+
+def build_augmented_prompt(user_prompt: str, context: str) -> str:
+    """Prepends the retrieved context, if any, to the user's question."""
+    if not context:
+        return user_prompt
+    return f"""En te basant sur le contexte suivant, réponds à la question de l'utilisateur.
+Si le contexte ne contient pas la réponse, utilise tes connaissances générales mais mentionne que l'information ne vient pas des documents fournis.
+Contexte:
+---
+{context}
+---
+Question de l'utilisateur: {user_prompt}"""
+
+def prepare_chat_turn(user_id: str, session_id: str, parent_message_id: str | None):
+    """
+    Resolves the parent message of a new turn and starts a chat session on its branch.
+
+    Returns the session and messages references, the parent message ID and the chat session.
+    """
+    session_ref = db.collection('users').document(user_id).collection('sessions').document(session_id)
+    messages_ref = session_ref.collection('messages')
+
+    parent_id = parent_message_id
+    if not parent_id:
+        try:
+            session_doc = session_ref.get()
+            if session_doc.exists:
+                parent_id = session_doc.to_dict().get('latest_message_id')
+        except Exception as e:
+            logger.warning(f"Could not fetch session to get latest_message_id: {e}")
+            parent_id = None
+
+    history = get_history_for_branch(messages_ref, parent_id)
+    chat_session = model.start_chat(history=history)
+    return session_ref, messages_ref, parent_id, chat_session
+
 @app.post("/api/chat", tags=["AI"])
 @limiter.limit("60/minute")
 async def handle_chat(request: Request, req_body: ChatRequest, token: dict = Depends(verify_token)):
@@ -381,50 +718,11 @@ async def handle_chat(request: Request, req_body: ChatRequest, token: dict = Dep
             raise HTTPException(status_code=400, detail="User ID not found in token.")
 
         # --- RAG & Context Augmentation ---
-        context = ""
-        if chroma_service.is_ready():
-            try:
-                embedding_result = genai.embed_content(model="models/text-embedding-004", content=[req_body.prompt], task_type="RETRIEVAL_QUERY")
-                prompt_embedding = embedding_result['embedding'][0]
-
-                search_results = chroma_service.query_collection(query_embedding=prompt_embedding, num_results=3)
-
-                # Les documents sont directement dans la réponse de ChromaDB
-                documents = search_results.get('documents', [[]])[0]
-                if documents:
-                    context = "\n---\n".join(documents)
-            except Exception as e:
-                logger.error(f"Erreur pendant la recherche RAG avec ChromaDB: {e}")
-                # On continue sans contexte en cas d'erreur
-
-        if context:
-            augmented_prompt = f"""En te basant sur le contexte suivant, réponds à la question de l'utilisateur.
-Si le contexte ne contient pas la réponse, utilise tes connaissances générales mais mentionne que l'information ne vient pas des documents fournis.
-Contexte:
----
-{context}
----
-Question de l'utilisateur: {req_body.prompt}"""
-        else:
-            augmented_prompt = req_body.prompt
-
-        # --- Versioning Logic ---
-        session_ref = db.collection('users').document(user_id).collection('sessions').document(req_body.session_id)
-        messages_ref = session_ref.collection('messages')
-
-        parent_id = req_body.parent_message_id
-        if not parent_id:
-            try:
-                session_doc = session_ref.get()
-                if session_doc.exists:
-                    parent_id = session_doc.to_dict().get('latest_message_id')
-            except Exception as e:
-                logger.warning(f"Could not fetch session to get latest_message_id: {e}")
-                parent_id = None
+        context = (await retrieve_contexts([req_body.prompt], hedge=True))[0]
+        augmented_prompt = build_augmented_prompt(req_body.prompt, context)
 
-        # --- New History Retrieval & ID Generation ---
-        history = get_history_for_branch(messages_ref, parent_id)
-        chat_session = model.start_chat(history=history)
+        # --- Versioning Logic, History Retrieval & ID Generation ---
+        session_ref, messages_ref, parent_id, chat_session = prepare_chat_turn(user_id, req_body.session_id, req_body.parent_message_id)
 
         user_message_id = str(uuid.uuid4())
         model_message_id = str(uuid.uuid4())
@@ -442,6 +740,48 @@ Question de l'utilisateur: {req_body.prompt}"""
         raise HTTPException(status_code=500, detail=f"Erreur interne lors du traitement du chat: {str(e)}")
 
 
+@app.post("/api/chat/batch", tags=["AI"], dependencies=[Depends(count_batch_items)])
+@limiter.limit("60/minute", cost=batch_item_cost)
+async def handle_chat_batch(request: Request, req_body: BatchChatRequest, token: dict = Depends(verify_token)):
+    """
+    Answers several chat requests and streams one NDJSON line per item, in completion order.
+
+    Query embeddings for all distinct prompts are computed in a single call and
+    identical requests are answered once. Requests on the same session without
+    a parent message branch from the same latest message.
+    """
+    if not db:
+        raise HTTPException(status_code=503, detail="La connexion à Firestore n'est pas disponible.")
+
+    user_id = token.get('uid')
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID not found in token.")
+
+    indices_by_item = {}
+    for index, item in enumerate(req_body.items):
+        indices_by_item.setdefault((item.prompt, item.session_id, item.parent_message_id), []).append(index)
+
+    prompts = list(dict.fromkeys(item.prompt for item in req_body.items))
+    contexts = dict(zip(prompts, await retrieve_contexts(prompts)))
+
+    def make_job(prompt, session_id, parent_message_id, indices):
+        async def job():
+            session_ref, messages_ref, parent_id, chat_session = await asyncio.to_thread(prepare_chat_turn, user_id, session_id, parent_message_id)
+            response = await generation_upstream.call(chat_session.send_message, build_augmented_prompt(prompt, contexts[prompt]))
+            reply = response.text
+
+            user_message_id = str(uuid.uuid4())
+            model_message_id = str(uuid.uuid4())
+            await asyncio.to_thread(save_chat_turn, messages_ref, session_ref, parent_id, user_message_id, model_message_id, prompt, reply)
+
+            result = {"session_id": session_id, "user_message_id": user_message_id, "model_message_id": model_message_id, "reply": reply}
+            return {index: result for index in indices}
+        return job
+
+    jobs = [(indices, make_job(*key, indices)) for key, indices in indices_by_item.items()]
+    logger.info(f"Chat batch: {len(req_body.items)} items, {len(jobs)} unique requests, {len(prompts)} embeddings.")
+    return StreamingResponse(stream_batch_results(jobs), media_type="application/x-ndjson")
+
 @app.get("/api/is_admin", tags=["Auth"])
 async def check_admin_status(token: dict = Depends(verify_admin)):
     """
@@ -451,6 +791,66 @@ async def check_admin_status(token: dict = Depends(verify_admin)):
     return {"is_admin": True}
 
 
+# --- Maintenance de la base de connaissances (ChromaDB) ---
+
+async def run_knowledge_maintenance(operation, *args, **kwargs):
+    """
+    Runs a blocking ChromaDB maintenance operation in a worker thread and maps its errors to HTTP errors.
+    """
+    if not chroma_service.is_ready():
+        raise HTTPException(status_code=503, detail="Le service ChromaDB n'est pas disponible.")
+    try:
+        return await asyncio.to_thread(operation, *args, **kwargs)
+    except chroma_service.ReindexInProgressError as e:
+        logger.warning(f"Maintenance refusée pendant la réindexation de ChromaDB: {e}")
+        raise HTTPException(status_code=503, detail="La base de connaissances est en cours de réindexation, réessayez plus tard.", headers={"Retry-After": str(e.retry_after)})
+    except ConnectionError as e:
+        logger.error(f"Erreur de communication avec ChromaDB: {e}")
+        raise HTTPException(status_code=503, detail=f"Erreur de communication avec ChromaDB: {e}")
+    except Exception as e:
+        logger.error(f"Erreur inattendue lors de la maintenance de ChromaDB: {e}")
+        raise HTTPException(status_code=500, detail=f"Erreur inattendue lors de la maintenance de ChromaDB: {e}")
+
+@app.get("/api/admin/knowledge/stats", tags=["Admin"])
+async def get_knowledge_stats(token: dict = Depends(verify_admin)):
+    """
+    Returns the chunk count, the per-source sizes and the on-disk size of the knowledge collection.
+    """
+    return await run_knowledge_maintenance(chroma_service.get_collection_stats)
+
+@app.post("/api/admin/knowledge/delete-sources", tags=["Admin"])
+async def delete_knowledge_sources(req_body: DeleteSourcesRequest, token: dict = Depends(verify_admin)):
+    """
+    Deletes every chunk that belongs to the given source files.
+    """
+    deleted = await run_knowledge_maintenance(chroma_service.delete_by_source, req_body.source_files)
+    return {"source_files": req_body.source_files, "chunks_deleted": deleted}
+
+@app.get("/api/admin/knowledge/duplicates", tags=["Admin"])
+async def get_knowledge_duplicates(limit: int = Query(100, ge=0, le=1000), token: dict = Depends(verify_admin)):
+    """
+    Lists groups of chunks with identical content, by content hash, largest groups first.
+
+    Only the first `limit` groups are listed; `group_count` gives the total.
+    """
+    return await run_knowledge_maintenance(chroma_service.find_duplicates, limit=limit)
+
+@app.post("/api/admin/knowledge/deduplicate", tags=["Admin"])
+async def deduplicate_knowledge(token: dict = Depends(verify_admin)):
+    """
+    Deletes duplicate chunks, keeping one chunk per distinct content.
+    """
+    return await run_knowledge_maintenance(chroma_service.find_duplicates, remove=True, limit=0)
+
+@app.post("/api/admin/knowledge/reindex", tags=["Admin"])
+async def reindex_knowledge(token: dict = Depends(verify_admin)):
+    """
+    Rebuilds the knowledge collection into a fresh one and swaps it in atomically.
+    Queries keep being served during the rebuild; uploads wait until the swap.
+    """
+    return await run_knowledge_maintenance(chroma_service.reindex_collection)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
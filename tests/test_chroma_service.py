@@ -0,0 +1,110 @@
+import chromadb
+import pytest
+import chroma_service
+
+
+@pytest.fixture
+def knowledge(monkeypatch):
+    client = chromadb.EphemeralClient()
+    for existing in client.list_collections():
+        client.delete_collection(name=getattr(existing, "name", existing))
+    collection = client.create_collection(name=chroma_service.COLLECTION_NAME)
+    monkeypatch.setattr(chroma_service, "client", client)
+    monkeypatch.setattr(chroma_service, "collection", collection)
+    chroma_service.upsert_documents(
+        datapoint_ids=["a-1", "a-2", "b-1", "b-2"],
+        documents=["alpha", "beta", "alpha", "gamma"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 0.0], [0.5, 0.5]],
+        metadatas=[{"source_file": "a.txt"}, {"source_file": "a.txt"}, {"source_file": "b.txt"}, {"source_file": "b.txt"}],
+    )
+    return client
+
+
+def test_collection_stats_per_source(knowledge):
+    stats = chroma_service.get_collection_stats()
+    assert stats["chunk_count"] == 4
+    assert {s["source_file"]: s["chunks"] for s in stats["sources"]} == {"a.txt": 2, "b.txt": 2}
+
+
+def test_delete_by_source(knowledge):
+    assert chroma_service.delete_by_source(["a.txt"]) == 2
+    assert chroma_service.collection.count() == 2
+
+
+def test_find_and_remove_duplicates(knowledge):
+    report = chroma_service.find_duplicates()
+    assert report["redundant_chunks"] == 1 and report["deleted"] == 0
+    assert sorted(report["groups"][0]["ids"]) == ["a-1", "b-1"]
+    assert chroma_service.find_duplicates(remove=True)["deleted"] == 1
+    assert chroma_service.collection.count() == 3
+
+
+def test_duplicate_report_is_bounded(knowledge):
+    chroma_service.upsert_documents(
+        datapoint_ids=["c-1", "c-2"],
+        documents=["gamma", "gamma"],
+        embeddings=[[0.5, 0.5], [0.5, 0.5]],
+        metadatas=[{"source_file": "c.txt"}, {"source_file": "c.txt"}],
+    )
+    report = chroma_service.find_duplicates(limit=1)
+    assert report["group_count"] == 2 and report["redundant_chunks"] == 3
+    assert sorted(report["groups"][0]["ids"]) == ["b-2", "c-1", "c-2"]
+
+
+def test_duplicate_scan_does_not_take_the_write_lock(knowledge, monkeypatch):
+    class ForbiddenLock:
+        def __enter__(self):
+            raise AssertionError("read-only scan took the write lock")
+
+        def __exit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(chroma_service, "_write_lock", ForbiddenLock())
+    assert chroma_service.find_duplicates()["redundant_chunks"] == 1
+
+
+def test_reindex_swaps_in_a_fresh_collection(knowledge):
+    old_id = chroma_service.collection.id
+    assert chroma_service.reindex_collection()["chunks"] == 4
+    assert chroma_service.collection.id != old_id
+    assert chroma_service.collection.name == chroma_service.COLLECTION_NAME
+    assert len(knowledge.list_collections()) == 1
+    results = chroma_service.query_collection(query_embedding=[0.0, 1.0], num_results=1)
+    assert results["documents"][0] == ["beta"]
+
+
+def test_writes_fail_fast_and_queries_are_served_during_reindex(knowledge):
+    import asyncio
+    import threading
+    # Simule une réindexation en cours : les deux verrous sont tenus par un autre fil.
+    held, done = threading.Event(), threading.Event()
+
+    def reindex():
+        with chroma_service._reindex_lock, chroma_service._write_lock:
+            held.set()
+            done.wait(5)
+
+    holder = threading.Thread(target=reindex)
+    holder.start()
+    held.wait()
+    try:
+        assert chroma_service.is_reindexing()
+
+        async def scenario():
+            writes = [
+                asyncio.to_thread(chroma_service.upsert_documents, [f"w-{i}"], ["delta"], [[0.0, 1.0]], [{"source_file": "w.txt"}])
+                for i in range(10)
+            ]
+            query = asyncio.to_thread(chroma_service.query_collection, query_embedding=[0.0, 1.0], num_results=1)
+            return await asyncio.wait_for(asyncio.gather(query, *writes, return_exceptions=True), timeout=2)
+
+        results = asyncio.run(scenario())
+        assert results[0]["documents"][0] == ["beta"]
+        assert all(isinstance(r, chroma_service.ReindexInProgressError) for r in results[1:])
+        with pytest.raises(chroma_service.ReindexInProgressError):
+            chroma_service.reindex_collection()
+    finally:
+        done.set()
+        holder.join()
+    assert not chroma_service.is_reindexing()
+    chroma_service.upsert_documents(["w-0"], ["delta"], [[0.0, 1.0]], [{"source_file": "w.txt"}])
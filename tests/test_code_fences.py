@@ -0,0 +1,41 @@
+import pytest
+from code_fences import CodeFenceStripper, strip_code_fences
+
+
+def reference_strip(text):
+    """The original, non-streaming fence stripping from generate_code."""
+    if text.strip().startswith("```"):
+        lines = text.strip().split('\n')
+        return '\n'.join(lines[1:-1])
+    return text
+
+
+SAMPLES = [
+    "```python\nprint('a')\nprint('b')\n```",
+    "\n  ```py\nx = 1\n\n```\n\n",
+    "```\nonly\n```",
+    "```py\nno closing fence",
+    "```inline```",
+    "def f():\n    return '```'\n",
+    "  plain code\n",
+    "``",
+    "",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_strip_code_fences_matches_reference(text):
+    assert strip_code_fences(text) == reference_strip(text)
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_stripper_is_independent_of_chunking(text):
+    for size in (1, 2, 3, 5):
+        stripper = CodeFenceStripper()
+        out = "".join(stripper.feed(text[i:i + size]) for i in range(0, len(text), size))
+        assert out + stripper.flush() == reference_strip(text)
+
+
+def test_stripper_releases_complete_lines_early():
+    stripper = CodeFenceStripper()
+    assert stripper.feed("```python\nline1\nline2\nli") == "line1\nline2"
@@ -0,0 +1,65 @@
+import pytest
+import redis
+import code_store
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.data = {}
+        self.fail = fail
+
+    def set(self, key, value, ex=None):
+        if self.fail:
+            raise redis.exceptions.ConnectionError("down")
+        self.data[key] = value
+
+    def getdel(self, key):
+        if self.fail:
+            raise redis.exceptions.ConnectionError("down")
+        return self.data.pop(key, None)
+
+
+class DictStore(code_store.CodeStore):
+    def __init__(self):
+        super().__init__()
+        self.data = {}
+        self.takes = 0
+
+    def put(self, code_id, code, filename):
+        self.data[code_id] = {'code': code, 'filename': filename}
+        return code_id
+
+    def take(self, code_id):
+        self.takes += 1
+        return self.data.pop(code_id, None)
+
+
+def test_redis_store_take_is_one_shot():
+    store = code_store.RedisCodeStore(FakeRedis(), ttl_seconds=60)
+    store.put("abc", "print('hi')", "script.py")
+    assert store.take("abc") == {'code': "print('hi')", 'filename': "script.py"}
+    assert store.take("abc") is None
+
+
+def test_code_store_is_abstract():
+    with pytest.raises(TypeError):
+        code_store.CodeStore()
+
+
+def test_fallback_store_is_used_when_redis_is_down():
+    fallback = DictStore()
+    store = code_store.FallbackCodeStore(code_store.RedisCodeStore(FakeRedis(fail=True)), fallback)
+    code_id = store.put("abc", "x = 1", "a.py")
+    assert code_id == code_store.FALLBACK_ID_PREFIX + "abc"
+    assert store.take(code_id) == {'code': "x = 1", 'filename': "a.py"}
+
+
+def test_primary_miss_does_not_query_fallback():
+    fallback = DictStore()
+    store = code_store.FallbackCodeStore(code_store.RedisCodeStore(FakeRedis()), fallback)
+    code_id = store.put("abc", "x = 1", "a.py")
+    assert code_id == "abc"
+    assert store.take(code_id) is not None
+    assert store.take(code_id) is None
+    assert store.take("unknown") is None
+    assert fallback.takes == 0
@@ -37,3 +37,207 @@ def test_rate_limiting():
     # Let's just verify the test setup is working. We will not test the rate limiter directly
     # as it requires a more complex setup (e.g., mocking redis, time, etc.)
     # and a valid token.
+
+
+class _FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _DictCodeStore:
+    def __init__(self):
+        self.data = {}
+
+    def put(self, code_id, code, filename):
+        self.data[code_id] = {'code': code, 'filename': filename}
+        return code_id
+
+    def take(self, code_id):
+        return self.data.pop(code_id, None)
+
+
+@pytest.fixture
+def authed(monkeypatch):
+    import main
+    from auth import verify_token
+    store = _DictCodeStore()
+    monkeypatch.setattr(main, "generated_code_store", store)
+    monkeypatch.setattr(main, "redis_client", None)
+    main.app.dependency_overrides[verify_token] = lambda: {"uid": "test-user"}
+    yield main, store
+    main.app.dependency_overrides.clear()
+
+
+def test_generate_code_stream_ends_with_code_id_trailer(authed, monkeypatch):
+    main, store = authed
+    chunks = ["```python\nprint(\"ERREUR: ", "fichier introuvable\")\n", "```"]
+
+    async def fake_stream(*args, **kwargs):
+        for c in chunks:
+            yield _FakeChunk(c)
+
+    monkeypatch.setattr(main.generation_stream_upstream, "stream", fake_stream)
+
+    response = client.post("/api/generate-code/stream", json={"prompt": "p", "filename": "a.py"})
+    body = response.text
+    code, trailer = body[:body.rindex("\n__")], body[body.rindex("\n__") + 1:].strip()
+
+    assert code == 'print("ERREUR: fichier introuvable")'
+    _, code_id, filename = trailer.split("::")
+    assert filename == "a.py"
+    assert store.data[code_id]["code"] == code
+
+
+def test_generate_code_stream_reports_errors_in_trailer(authed, monkeypatch):
+    main, store = authed
+
+    async def failing_stream(*args, **kwargs):
+        raise RuntimeError("upstream\nexploded")
+        yield
+
+    monkeypatch.setattr(main.generation_stream_upstream, "stream", failing_stream)
+    response = client.post("/api/generate-code/stream", json={"prompt": "p", "filename": "a.py"})
+    assert response.text.endswith("\n__ERROR__::upstream exploded\n")
+    assert not store.data
+
+
+def _collect(agen):
+    import asyncio, json
+
+    async def consume():
+        return [json.loads(line) async for line in agen]
+
+    return asyncio.run(consume())
+
+
+def test_stream_batch_results_yields_in_completion_order_with_errors_per_index(authed):
+    import asyncio
+    main, _ = authed
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return {0: {"value": "slow"}}
+
+    async def fast():
+        return {1: {"value": "fast"}, 2: {"value": "fast"}}
+
+    async def failing():
+        await asyncio.sleep(0.02)
+        raise RuntimeError("boom")
+
+    lines = _collect(main.stream_batch_results([([0], slow), ([1, 2], fast), ([3, 4], failing)]))
+
+    assert [line["index"] for line in lines] == [1, 2, 3, 4, 0]
+    assert lines[0] == {"index": 1, "status": "ok", "value": "fast"}
+    assert lines[2] == {"index": 3, "status": "error", "detail": "boom"}
+    assert lines[3] == {"index": 4, "status": "error", "detail": "boom"}
+    assert lines[4] == {"index": 0, "status": "ok", "value": "slow"}
+
+
+def test_stream_batch_results_bounds_concurrency(authed, monkeypatch):
+    import asyncio
+    main, _ = authed
+    monkeypatch.setattr(main, "BATCH_MAX_CONCURRENCY", 2)
+    running = [0]
+    peak = [0]
+
+    def make_job(index):
+        async def job():
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+            return {index: {}}
+        return job
+
+    lines = _collect(main.stream_batch_results([([i], make_job(i)) for i in range(6)]))
+
+    assert sorted(line["index"] for line in lines) == list(range(6))
+    assert peak[0] == 2
+
+
+def test_generate_code_batch_generates_duplicate_prompts_once(authed, monkeypatch):
+    import json
+    main, store = authed
+    main.limiter.reset()
+    calls = []
+
+    async def fake_generate(prompt, cache_key):
+        calls.append(prompt)
+        return f"code for {prompt}"
+
+    monkeypatch.setattr(main, "generate_code_text", fake_generate)
+    items = [{"prompt": "a", "filename": "a1.py"}, {"prompt": "b", "filename": "b.py"}, {"prompt": "a", "filename": "a2.py"}]
+    response = client.post("/api/generate-code/batch", json={"items": items})
+    lines = {line["index"]: line for line in map(json.loads, response.text.splitlines())}
+
+    assert sorted(calls) == ["a", "b"]
+    assert lines[0]["code_id"] != lines[2]["code_id"]
+    assert store.data[lines[0]["code_id"]] == {"code": "code for a", "filename": "a1.py"}
+    assert store.data[lines[2]["code_id"]] == {"code": "code for a", "filename": "a2.py"}
+
+
+def test_batch_rate_limit_charges_each_item(authed, monkeypatch):
+    main, _ = authed
+    main.limiter.reset()
+
+    async def fake_generate(prompt, cache_key):
+        return "code"
+
+    monkeypatch.setattr(main, "generate_code_text", fake_generate)
+    items = [{"prompt": str(i)} for i in range(main.BATCH_MAX_ITEMS)]
+    assert client.post("/api/generate-code/batch", json={"items": items}).status_code == 200
+    # 20 éléments déjà décomptés sur une limite de 30/minute : un second lot complet est refusé.
+    assert client.post("/api/generate-code/batch", json={"items": items}).status_code == 429
+    main.limiter.reset()
+
+
+def test_stream_and_unary_generation_latencies_do_not_collapse_the_limit(authed):
+    import asyncio
+    main, _ = authed
+    stream_limiter = main.generation_stream_upstream.limiter
+    unary_limiter = main.generation_upstream.limiter
+    assert stream_limiter is not unary_limiter
+    initial = (stream_limiter.limit, unary_limiter.limit)
+
+    async def scenario():
+        # Premiers fragments des flux de chat (~0,6 s), puis générations complètes (~8 s).
+        for limiter, latency in [(stream_limiter, 0.6)] * 20 + [(unary_limiter, 8.0)] * 30:
+            await limiter.acquire()
+            limiter.release(latency=latency)
+
+    asyncio.run(scenario())
+    assert stream_limiter.limit >= initial[0]
+    assert unary_limiter.limit >= initial[1]
+
+
+def test_upload_embeds_chunks_in_batches(authed, monkeypatch):
+    main, _ = authed
+    main.limiter.reset()
+    batch_sizes = []
+    upserted = {}
+
+    async def fake_embed(fn, **kwargs):
+        batch_sizes.append(len(kwargs["content"]))
+        return {"embedding": [[0.0]] * len(kwargs["content"])}
+
+    monkeypatch.setattr(main.document_embedding_upstream, "call", fake_embed)
+    monkeypatch.setattr(main.chroma_service, "is_ready", lambda: True)
+    monkeypatch.setattr(main.chroma_service, "upsert_documents", lambda **kwargs: upserted.update(kwargs))
+    monkeypatch.setattr(main, "db", object())
+
+    # Fragments de 1000 caractères avec un pas de 800 : 250 fragments.
+    text = "x" * (800 * 250)
+    response = client.post("/api/upload", files={"file": ("doc.txt", text.encode(), "text/plain")})
+
+    assert response.status_code == 200
+    assert batch_sizes == [100, 100, 50]
+    assert len(upserted["embeddings"]) == 250
+
+
+@pytest.mark.parametrize("filename", ["a::b.py", "a.py\n", "a\nb.py", "../a.py", 'a".py'])
+def test_code_generation_rejects_filenames_that_break_the_trailer(authed, filename):
+    main, _ = authed
+    main.limiter.reset()
+    response = client.post("/api/generate-code/stream", json={"prompt": "p", "filename": filename})
+    assert response.status_code == 422
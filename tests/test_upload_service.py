@@ -0,0 +1,66 @@
+import asyncio
+import io
+import pytest
+import upload_service
+
+
+def test_iter_txt_text_handles_split_multibyte_characters(monkeypatch):
+    monkeypatch.setattr(upload_service, "READ_BLOCK_SIZE", 1)
+    text = "Déjà vu — 日本"
+    assert "".join(upload_service.iter_txt_text(io.BytesIO(text.encode("utf-8")))) == text
+
+
+@pytest.mark.parametrize("length", [0, 1, 799, 1000, 1500, 4321])
+def test_iter_text_chunks_matches_slicing(length):
+    text = "".join(chr(65 + i % 26) for i in range(length))
+    pieces = [text[i:i + 333] for i in range(0, len(text), 333)]
+    expected = [text[i:i + 1000] for i in range(0, len(text), 800)]
+    assert list(upload_service.iter_text_chunks(pieces, chunk_size=1000, overlap=200)) == expected
+
+
+async def _read_body_app(scope, receive, send):
+    """A minimal ASGI app that reads the whole body, then answers 200 with its size."""
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("client disconnected")
+        size += len(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": str(size).encode()})
+
+
+def _run_middleware(body_parts, headers=(), path="/api/upload", max_body_bytes=10):
+    middleware = upload_service.UploadSizeLimitMiddleware(_read_body_app, paths=["/api/upload"], max_body_bytes=max_body_bytes)
+    messages = [{"type": "http.request", "body": part, "more_body": i < len(body_parts) - 1} for i, part in enumerate(body_parts)]
+    received = []
+    sent = []
+
+    async def receive():
+        message = messages.pop(0)
+        received.append(message)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "headers": list(headers)}
+    asyncio.run(middleware(scope, receive, send))
+    return sent[0]["status"], len(received)
+
+
+def test_middleware_rejects_on_content_length_without_reading_body():
+    status, reads = _run_middleware([b"x" * 20], headers=[(b"content-length", b"20")])
+    assert (status, reads) == (413, 0)
+
+
+def test_middleware_stops_reading_once_limit_is_crossed():
+    status, reads = _run_middleware([b"x" * 6, b"x" * 6, b"x" * 6])
+    assert (status, reads) == (413, 2)
+
+
+def test_middleware_passes_small_bodies_and_other_paths():
+    assert _run_middleware([b"x" * 5, b"x" * 5])[0] == 200
+    assert _run_middleware([b"x" * 20], path="/api/chat")[0] == 200
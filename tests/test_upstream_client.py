@@ -0,0 +1,222 @@
+import asyncio
+import threading
+import time
+import pytest
+from google.api_core import exceptions as google_exceptions
+from upstream_client import (
+    AdaptiveConcurrencyLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    ConcurrencyLimitError,
+    UpstreamClient,
+    UpstreamTimeoutError,
+)
+
+
+class FakeUpstream:
+    """A fake upstream that injects latency and errors, one script entry per call."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = 0
+        self.kwargs = []
+        self._lock = threading.Lock()
+
+    def __call__(self, value, **kwargs):
+        with self._lock:
+            step = self.script[min(self.calls, len(self.script) - 1)]
+            self.calls += 1
+            self.kwargs.append(kwargs)
+        latency, error = step
+        time.sleep(latency)
+        if error:
+            raise error
+        return value
+
+
+async def no_sleep(_):
+    pass
+
+
+def make_client(**kwargs):
+    kwargs.setdefault("timeout", 1.0)
+    kwargs.setdefault("sleep", no_sleep)
+    return UpstreamClient("test", **kwargs)
+
+
+def test_idempotent_call_is_retried_after_429():
+    upstream = FakeUpstream([(0, google_exceptions.ResourceExhausted("quota")), (0, None)])
+    assert asyncio.run(make_client().call(upstream, "ok", idempotent=True)) == "ok"
+    assert upstream.calls == 2
+
+
+def test_non_idempotent_call_is_not_retried():
+    upstream = FakeUpstream([(0, google_exceptions.ServiceUnavailable("down")), (0, None)])
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        asyncio.run(make_client().call(upstream, "ok"))
+    assert upstream.calls == 1
+
+
+def test_client_errors_are_not_retried():
+    upstream = FakeUpstream([(0, google_exceptions.InvalidArgument("bad")), (0, None)])
+    with pytest.raises(google_exceptions.InvalidArgument):
+        asyncio.run(make_client().call(upstream, "ok", idempotent=True))
+    assert upstream.calls == 1
+
+
+def test_deadline_raises_timeout():
+    upstream = FakeUpstream([(0.5, None)])
+    with pytest.raises(UpstreamTimeoutError):
+        asyncio.run(make_client(timeout=0.05).call(upstream, "ok"))
+
+
+def test_deadline_covers_all_attempts():
+    # Chaque tentative dépasse le délai : il ne doit pas y en avoir de seconde avec un délai neuf.
+    upstream = FakeUpstream([(0.3, None)])
+    client = make_client(timeout=0.1, max_retries=3)
+    start = time.monotonic()
+    with pytest.raises(UpstreamTimeoutError):
+        asyncio.run(client.call(upstream, "ok", idempotent=True))
+    assert time.monotonic() - start < 0.25
+    assert upstream.calls == 1
+
+
+def test_remaining_time_is_passed_to_upstream():
+    upstream = FakeUpstream([(0, None)])
+    client = make_client(timeout=2.0, timeout_kwargs=lambda remaining: {"request_options": {"timeout": remaining}})
+    asyncio.run(client.call(upstream, "ok"))
+    assert 0 < upstream.kwargs[0]["request_options"]["timeout"] <= 2.0
+
+
+def test_hedged_request_wins_over_slow_first_attempt():
+    upstream = FakeUpstream([(0.5, None), (0, None)])
+    client = make_client(hedge_delay=0.02)
+    start = time.monotonic()
+    assert asyncio.run(client.call(upstream, "ok", idempotent=True, hedge=True)) == "ok"
+    assert time.monotonic() - start < 0.4
+    assert upstream.calls == 2
+
+
+def test_circuit_opens_then_recovers_after_probe():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0, clock=lambda: now[0])
+    client = make_client(max_retries=0, breaker=breaker)
+    failing = FakeUpstream([(0, google_exceptions.ServiceUnavailable("down"))])
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(google_exceptions.ServiceUnavailable):
+                await client.call(failing, "ok")
+        with pytest.raises(CircuitOpenError):
+            await client.call(failing, "ok")
+        assert failing.calls == 2
+
+        now[0] = 11.0
+        assert await client.call(FakeUpstream([(0, None)]), "ok") == "ok"
+
+    asyncio.run(scenario())
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_limiter_shrinks_on_errors_and_grows_on_success():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=10, max_limit=20)
+
+    async def scenario():
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(overloaded=True)
+        shrunk = limiter.limit
+        assert shrunk < 10
+        for _ in range(200):
+            await limiter.acquire()
+            limiter.release(latency=0.01)
+        assert limiter.limit > shrunk
+
+    asyncio.run(scenario())
+
+
+def test_limiter_shrinks_on_latency_alone():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=10, latency_tolerance=2.0)
+
+    async def scenario():
+        await limiter.acquire()
+        limiter.release(latency=0.01)
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(latency=0.5)
+
+    asyncio.run(scenario())
+    assert limiter.limit < 10
+
+
+def test_errors_only_limiter_ignores_latency_but_shrinks_on_overload():
+    # Des générations de durées très différentes ne doivent pas faire s'effondrer la limite.
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=10, latency_tolerance=None)
+
+    async def scenario():
+        for latency in [0.6] * 20 + [8.0] * 30:
+            await limiter.acquire()
+            limiter.release(latency=latency)
+        assert limiter.limit >= 10
+        await limiter.acquire()
+        limiter.release(overloaded=True)
+
+    asyncio.run(scenario())
+    assert limiter.limit < 15
+
+
+def test_limiter_rejects_after_queue_timeout():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1)
+
+    async def scenario():
+        await limiter.acquire()
+        with pytest.raises(ConcurrencyLimitError):
+            await limiter.acquire(timeout=0.01)
+        limiter.release()
+        await limiter.acquire(timeout=0.01)
+
+    asyncio.run(scenario())
+    assert limiter.in_flight == 1
+
+
+def test_stream_yields_chunks_and_releases_slot():
+    client = make_client()
+
+    async def consume():
+        return [chunk async for chunk in client.stream(lambda: iter(["a", "b", "c"]))]
+
+    assert asyncio.run(consume()) == ["a", "b", "c"]
+    assert client.limiter.in_flight == 0
+
+
+def test_held_stream_does_not_block_the_event_loop():
+    # Un seul slot : le flux le garde pendant qu'un appel concurrent attend son tour.
+    client = make_client(limiter=AdaptiveConcurrencyLimiter(initial_limit=1, max_limit=1), queue_timeout=2.0)
+    release_stream = threading.Event()
+
+    def slow_stream():
+        yield "a"
+        release_stream.wait(2.0)
+        yield "b"
+
+    async def scenario():
+        async def consume():
+            return [chunk async for chunk in client.stream(slow_stream)]
+
+        stream_task = asyncio.create_task(consume())
+        await asyncio.sleep(0.05)
+        call_task = asyncio.create_task(client.call(FakeUpstream([(0, None)]), "ok"))
+
+        # La boucle reste libre : ce coroutine continue de tourner pendant que le flux et l'appel attendent.
+        start = time.monotonic()
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+        assert time.monotonic() - start < 0.5
+        assert not call_task.done()
+
+        release_stream.set()
+        assert await stream_task == ["a", "b"]
+        assert await call_task == "ok"
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=3.0))
+    assert client.limiter.in_flight == 0
@@ -0,0 +1,144 @@
+# upload_service.py
+# --- Imports ---
+import codecs
+import json
+import logging
+import os
+from typing import BinaryIO, Iterable, Iterator
+from pypdf import PdfReader
+
+# --- Logging Configuration ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Upload Service ---
+
+# Taille des blocs lus depuis le fichier uploadé (64 Ko).
+READ_BLOCK_SIZE = 64 * 1024
+# Marge accordée à l'enveloppe multipart (en-têtes de partie, délimiteurs) au-delà de la taille du fichier.
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI middleware that rejects oversized request bodies before they are parsed.
+
+    For the given paths, a request whose Content-Length exceeds `max_body_bytes`
+    is answered with 413 without reading the body. Bodies without a usable
+    Content-Length (e.g. chunked) are counted as they are received: once the
+    limit is crossed, the application sees a client disconnect, its response is
+    discarded and a 413 is sent instead. Nothing past the limit is buffered.
+    """
+
+    def __init__(self, app, paths: list[str], max_body_bytes: int):
+        self.app = app
+        self.paths = set(paths)
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            await self._reject(send)
+            return
+
+        state = {"received": 0, "exceeded": False, "response_started": False}
+
+        async def limited_receive():
+            if state["exceeded"]:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > self.max_body_bytes:
+                    state["exceeded"] = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            if state["exceeded"]:
+                return
+            if message["type"] == "http.response.start":
+                state["response_started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not state["exceeded"]:
+                raise
+        if state["exceeded"] and not state["response_started"]:
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"La requête dépasse la taille maximale autorisée de {self.max_body_bytes} octets."}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def get_upload_size(stream: BinaryIO) -> int:
+    """Return the size in bytes of a seekable upload stream and rewind it."""
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def iter_pdf_text(stream: BinaryIO) -> Iterator[str]:
+    """
+    Yield the extracted text of each page of a PDF.
+
+    The stream (typically the upload's own spooled file) is handed to
+    `PdfReader` as-is, so the bytes are parsed in place rather than copied.
+    """
+    reader = PdfReader(stream)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def iter_txt_text(stream: BinaryIO, encoding: str = "utf-8") -> Iterator[str]:
+    """
+    Decode a text stream block by block with an incremental decoder.
+
+    Multi-byte characters split across block boundaries are handled by the
+    decoder; invalid input raises `UnicodeDecodeError`.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        block = stream.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_text_chunks(pieces: Iterable[str], chunk_size: int = 1000, overlap: int = 200) -> Iterator[str]:
+    """
+    Split a stream of text pieces into overlapping chunks.
+
+    Produces the same chunks as slicing the concatenated text with a step of
+    `chunk_size - overlap`, without ever holding the whole text in memory.
+    """
+    step = chunk_size - overlap
+    buffer = ""
+    start = 0
+    for piece in pieces:
+        buffer = buffer[start:] + piece
+        start = 0
+        while len(buffer) - start >= chunk_size:
+            yield buffer[start:start + chunk_size]
+            start += step
+    while start < len(buffer):
+        yield buffer[start:start + chunk_size]
+        start += step
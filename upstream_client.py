@@ -0,0 +1,379 @@
+# upstream_client.py
+# --- Imports ---
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import random
+import threading
+import time
+from google.api_core import exceptions as google_exceptions
+
+# --- Logging Configuration ---
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Resilient Upstream Client ---
+
+# Erreurs qui signalent une surcharge ou une indisponibilité transitoire de l'upstream.
+# Elles ouvrent le disjoncteur, réduisent la concurrence et peuvent être retentées.
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+    TimeoutError,
+    ConnectionError,
+)
+
+_END_OF_STREAM = object()
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised when a call is rejected locally to protect an overloaded upstream."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Raised when the circuit breaker is open."""
+
+
+class ConcurrencyLimitError(UpstreamUnavailableError):
+    """Raised when no concurrency slot frees up within the queue timeout."""
+
+
+class UpstreamTimeoutError(TimeoutError):
+    """Raised when an upstream call misses its deadline."""
+
+
+class CircuitBreaker:
+    """
+    A closed / open / half-open circuit breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    are rejected for `reset_timeout` seconds. A single probe call is then let
+    through: its success closes the circuit, its failure reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Reserve the right to call the upstream, or raise `CircuitOpenError`."""
+        with self._lock:
+            if self._state == self.OPEN:
+                remaining = self.reset_timeout - (self._clock() - self._opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError("Le circuit vers l'upstream est ouvert.", retry_after=remaining)
+                self._state = self.HALF_OPEN
+            if self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError("Un appel de test vers l'upstream est déjà en cours.", retry_after=1.0)
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"Circuit breaker opened after {self._failures} consecutive failures.")
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    An AIMD concurrency limit driven by observed latency and errors.
+
+    The limit grows by roughly one slot per window of successful calls and is
+    cut multiplicatively on overload errors or when latency exceeds
+    `latency_tolerance` times the best latency seen recently. The latency signal
+    is only meaningful if all calls through the limiter have comparable
+    latencies; set `latency_tolerance` to None to drive the limit by errors only
+    (e.g. for generations, whose duration depends on the length of the output).
+
+    Waiting for a slot suspends the calling coroutine instead of blocking its
+    thread, so slots held by in-flight calls and streams keep being released
+    while others wait. The limiter must be used from one event loop at a time.
+    """
+
+    def __init__(self, initial_limit: int = 10, min_limit: int = 1, max_limit: int = 50,
+                 backoff_ratio: float = 0.9, latency_tolerance: float | None = 2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._min_latency = None
+        self._waiters = collections.deque()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self, timeout: float | None = None):
+        """Wait for a free slot, or raise `ConcurrencyLimitError` after `timeout` seconds."""
+        if not self._waiters and self._in_flight < self.limit:
+            self._in_flight += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            # Le slot a pu être accordé au moment même où le délai expirait : on le garde.
+            if waiter.done() and not waiter.cancelled():
+                return
+            raise ConcurrencyLimitError("Trop d'appels simultanés vers l'upstream.", retry_after=1.0)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._in_flight -= 1
+                self._wake_waiters()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency: float | None = None, overloaded: bool = False):
+        """
+        Free a slot and adjust the limit.
+
+        `latency` is None when the call produced no usable signal (e.g. it was
+        rejected before reaching the upstream).
+        """
+        self._in_flight -= 1
+        if overloaded:
+            self._decrease()
+        elif latency is not None and self.latency_tolerance is None:
+            self._increase()
+        elif latency is not None:
+            # La référence remonte lentement pour suivre une dérive durable de la latence.
+            if self._min_latency is None:
+                self._min_latency = latency
+            else:
+                self._min_latency = min(latency, self._min_latency * 1.01)
+            if latency > self._min_latency * self.latency_tolerance:
+                self._decrease()
+            else:
+                self._increase()
+        self._wake_waiters()
+
+    def _increase(self):
+        self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+
+    def _decrease(self):
+        self._limit = max(float(self.min_limit), self._limit * self.backoff_ratio)
+
+    def _wake_waiters(self):
+        while self._waiters and self._in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+
+class UpstreamClient:
+    """
+    Wraps blocking calls to an upstream API with resilience policies, for use from async code.
+
+    The blocking upstream functions run in the client's own bounded thread pool,
+    never on the event loop. Every call is admitted by a circuit breaker and an
+    adaptive concurrency limit and is bounded by a single deadline covering all
+    of its attempts. Idempotent calls are retried with jittered exponential
+    backoff while the deadline allows it, and can be hedged: if the first
+    attempt has not answered after `hedge_delay` seconds, a second one is sent
+    and the first successful answer wins.
+
+    `timeout_kwargs`, if given, maps the time left before the deadline to extra
+    keyword arguments for the upstream function (e.g. a request timeout), so
+    that the upstream request itself is aborted rather than left running.
+    """
+
+    def __init__(self, name: str, timeout: float = 30.0, max_retries: int = 2,
+                 backoff_base: float = 0.2, backoff_max: float = 5.0,
+                 hedge_delay: float | None = None, queue_timeout: float = 5.0,
+                 stream_timeout: float | None = None,
+                 timeout_kwargs=None,
+                 breaker: CircuitBreaker | None = None,
+                 limiter: AdaptiveConcurrencyLimiter | None = None,
+                 sleep=asyncio.sleep):
+        self.name = name
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.queue_timeout = queue_timeout
+        self.stream_timeout = stream_timeout
+        self.timeout_kwargs = timeout_kwargs
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+        self._sleep = sleep
+        # Deux fils par slot : un pour l'appel, un pour une éventuelle requête couverte (hedge).
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.limiter.max_limit * 2, thread_name_prefix=f"upstream-{name}"
+        )
+
+    async def call(self, fn, *args, idempotent: bool = False, hedge: bool = False, **kwargs):
+        """
+        Call `fn(*args, **kwargs)` under the client's policies and return its result.
+
+        Args:
+            fn: The blocking upstream function.
+            idempotent (bool): Whether the call may be retried (and hedged) safely.
+            hedge (bool): Send a backup request after `hedge_delay` seconds. Ignored
+                for non-idempotent calls or when `hedge_delay` is not set.
+
+        Raises:
+            UpstreamUnavailableError: If the circuit is open or no slot is available.
+            UpstreamTimeoutError: If the call misses its deadline, retries included.
+        """
+        hedge = hedge and idempotent and self.hedge_delay is not None
+        deadline = time.monotonic() + self.timeout
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        for attempt in range(attempts):
+            try:
+                return await self._call_once(fn, args, kwargs, hedge, deadline)
+            except RETRYABLE_EXCEPTIONS as e:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                # Pas de nouvelle tentative si le délai global serait dépassé avant qu'elle ne commence.
+                if attempt == attempts - 1 or time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(f"[{self.name}] Upstream call failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.2f}s.")
+                await self._sleep(delay)
+
+    async def stream(self, fn, *args, **kwargs):
+        """
+        Call a streaming `fn(*args, **kwargs)` and yield its chunks.
+
+        The concurrency slot is held until the stream ends. The initial call and
+        the wait for each subsequent chunk are each bounded by `timeout`; the
+        upstream request as a whole is bounded by `stream_timeout`, if set.
+        Streams are never retried, since chunks may already have been consumed.
+        """
+        await self._acquire(time.monotonic() + self.timeout)
+        start = time.monotonic()
+        latency = None
+        overloaded = False
+        try:
+            if self.timeout_kwargs and self.stream_timeout:
+                kwargs = {**kwargs, **self.timeout_kwargs(self.stream_timeout)}
+            iterator = iter(await self._run(fn, args, kwargs, False, start + self.timeout))
+            latency = time.monotonic() - start
+            while True:
+                chunk = await self._run(next, (iterator, _END_OF_STREAM), {}, False, time.monotonic() + self.timeout)
+                if chunk is _END_OF_STREAM:
+                    break
+                yield chunk
+        except RETRYABLE_EXCEPTIONS:
+            overloaded = True
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.record_success()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            self.limiter.release(latency, overloaded)
+
+    async def _acquire(self, deadline: float):
+        queue_timeout = max(0.0, min(self.queue_timeout, deadline - time.monotonic()))
+        await self.limiter.acquire(queue_timeout)
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.limiter.release()
+            raise
+
+    async def _call_once(self, fn, args, kwargs, hedge: bool, deadline: float):
+        await self._acquire(deadline)
+        start = time.monotonic()
+        latency = None
+        overloaded = False
+        try:
+            if self.timeout_kwargs:
+                kwargs = {**kwargs, **self.timeout_kwargs(max(0.0, deadline - start))}
+            result = await self._run(fn, args, kwargs, hedge, deadline)
+            latency = time.monotonic() - start
+        except RETRYABLE_EXCEPTIONS:
+            overloaded = True
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # L'upstream a répondu (p. ex. requête invalide) : ce n'est pas une panne.
+            self.breaker.record_success()
+            raise
+        else:
+            self.breaker.record_success()
+            return result
+        finally:
+            self.limiter.release(latency, overloaded)
+
+    async def _run(self, fn, args, kwargs, hedge: bool, deadline: float):
+        loop = asyncio.get_running_loop()
+
+        def submit():
+            return loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+        pending = {submit()}
+        if hedge:
+            done, _ = await asyncio.wait(pending, timeout=max(0.0, min(self.hedge_delay, deadline - time.monotonic())))
+            if not done and deadline > time.monotonic():
+                logger.info(f"[{self.name}] No answer after {self.hedge_delay}s, sending a hedged request.")
+                pending.add(submit())
+
+        last_error = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                last_error = error
+
+        if pending:
+            for future in pending:
+                future.cancel()
+            raise UpstreamTimeoutError(f"[{self.name}] L'upstream n'a pas répondu dans le délai de {self.timeout}s.")
+        raise last_error